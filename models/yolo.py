@@ -18,7 +18,7 @@ from utils.general import LOGGER, check_version, check_yaml, make_divisible, pri
 from utils.plots import feature_visualization
 from utils.torch_utils import (fuse_conv_and_bn, initialize_weights, model_info, profile, scale_img, select_device,
                                time_sync)
-from utils.tal.anchor_generator import make_anchors, dist2bbox
+from utils.tal.anchor_generator import make_anchors, dist2bbox, topk_anchors
 from models.MSAM import C2f_MSAM
 from models.BCGAFusion import BCGAFusion
 from models.PPA import PPA
@@ -42,6 +42,8 @@ class Detect(nn.Module):
     # YOLO Detect head for detection models
     dynamic = False  # force grid reconstruction
     export = False  # export mode
+    topk = 0  # inference anchors per image kept ahead of DFL decoding and NMS, 0 for all
+    conf = 0.0  # inference score threshold that can lower topk, usually the NMS conf_thres
     shape = None
     anchors = torch.empty(0)  # init
     strides = torch.empty(0)  # init
@@ -73,7 +75,10 @@ class Detect(nn.Module):
             self.shape = shape
 
         box, cls = torch.cat([xi.view(shape[0], self.no, -1) for xi in x], 2).split((self.reg_max * 4, self.nc), 1)
-        dbox = dist2bbox(self.dfl(box), self.anchors.unsqueeze(0), xywh=True, dim=1) * self.strides
+        anchors, strides = self.anchors.unsqueeze(0), self.strides
+        if self.topk and not self.export:  # compact candidates, decoded and passed to NMS for the kept anchors only
+            box, cls, anchors, strides = topk_anchors(box, cls, self.anchors, self.strides, self.topk, self.conf)
+        dbox = dist2bbox(self.dfl(box), anchors, xywh=True, dim=1) * strides
         y = torch.cat((dbox, cls.sigmoid()), 1)
         return y if self.export else (y, x)
 
@@ -91,6 +96,8 @@ class DDetect(nn.Module):
     # YOLO Detect head for detection models
     dynamic = False  # force grid reconstruction
     export = False  # export mode
+    topk = 0  # inference anchors per image kept ahead of DFL decoding and NMS, 0 for all
+    conf = 0.0  # inference score threshold that can lower topk, usually the NMS conf_thres
     shape = None
     anchors = torch.empty(0)  # init
     strides = torch.empty(0)  # init
@@ -122,7 +129,10 @@ class DDetect(nn.Module):
             self.shape = shape
 
         box, cls = torch.cat([xi.view(shape[0], self.no, -1) for xi in x], 2).split((self.reg_max * 4, self.nc), 1)
-        dbox = dist2bbox(self.dfl(box), self.anchors.unsqueeze(0), xywh=True, dim=1) * self.strides
+        anchors, strides = self.anchors.unsqueeze(0), self.strides
+        if self.topk and not self.export:  # compact candidates, decoded and passed to NMS for the kept anchors only
+            box, cls, anchors, strides = topk_anchors(box, cls, self.anchors, self.strides, self.topk, self.conf)
+        dbox = dist2bbox(self.dfl(box), anchors, xywh=True, dim=1) * strides
         y = torch.cat((dbox, cls.sigmoid()), 1)
         return y if self.export else (y, x)
 
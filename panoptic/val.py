@@ -25,10 +25,10 @@ from utils.coco_utils import getCocoIds, getMappingId, getMappingIndex
 from utils.general import (LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size,
                            check_requirements, check_yaml, coco80_to_coco91_class, colorstr, increment_path,
                            non_max_suppression, print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, box_iou
+from utils.metrics import ConfusionMatrix, box_iou, match_predictions
 from utils.plots import output_to_target, plot_val_study
 from utils.panoptic.dataloaders import create_dataloader
-from utils.panoptic.general import mask_iou, process_mask, process_mask_upsample, scale_image
+from utils.panoptic.general import mask_iou, process_mask, process_mask_upsample, scale_image, semantic_onehot
 from utils.panoptic.metrics import Metrics, ap_per_class_box_and_mask, Semantic_Metrics
 from utils.panoptic.plots import plot_images_and_masks
 from utils.torch_utils import de_parallel, select_device, smart_inference_mode
@@ -90,19 +90,8 @@ def process_batch(detections, labels, iouv, pred_masks=None, gt_masks=None, over
     else:  # boxes
         iou = box_iou(labels[:, 1:], detections[:, :4])
 
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
     correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    return match_predictions(iou, correct_class, iouv)
 
 
 @smart_inference_mode()
@@ -235,7 +224,6 @@ def run(
                 masks = masks.to(device)
                 semasks = semasks.to(device)
             masks = masks.float()
-            semasks = semasks.float()
             im = im.half() if half else im.float()  # uint8 to fp16/32
             im /= 255  # 0 - 255 to 0.0 - 1.0
             nb, _, height, width = im.shape  # batch size, channels, height, width
@@ -268,7 +256,8 @@ def run(
                                         multi_label=True,
                                         agnostic=single_cls,
                                         max_det=max_det,
-                                        nm=nm)
+                                        nm=nm,
+                                        batched=True)
 
         # Metrics
         plot_masks = []  # masks for plotting
@@ -277,7 +266,7 @@ def run(
         if training:
             semantic_metrics.update(psemasks, semasks)
         else:
-            _, _, smh, smw = semasks.shape
+            smh, smw = semasks.shape[-2:]
             semantic_metrics.update(torch.nn.functional.interpolate(psemasks, size = (smh, smw), mode = 'bilinear', align_corners = False), semasks)
 
         if plots and batch_i < 3:
@@ -419,7 +408,8 @@ def run(
                 plot_masks = torch.cat(plot_masks, dim=0)
             if len(plot_semasks):
                 plot_semasks = torch.cat(plot_semasks, dim = 0)
-            plot_images_and_masks(im, targets, masks, semasks, paths, save_dir / f'val_batch{batch_i}_labels.jpg', names)
+            plot_images_and_masks(im, targets, masks, semantic_onehot(semasks, psemasks.shape[1]), paths,
+                                  save_dir / f'val_batch{batch_i}_labels.jpg', names)  # labels
             plot_images_and_masks(im, output_to_target(preds, max_det=15), plot_masks, plot_semasks, paths,
                                   save_dir / f'val_batch{batch_i}_pred.jpg', names)  # pred
 
@@ -23,7 +23,7 @@ from utils.callbacks import Callbacks
 from utils.general import (LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size,
                            check_requirements, check_yaml, coco80_to_coco91_class, colorstr, increment_path,
                            non_max_suppression, print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, box_iou
+from utils.metrics import ConfusionMatrix, box_iou, match_predictions
 from utils.plots import output_to_target, plot_val_study
 from utils.segment.dataloaders import create_dataloader
 from utils.segment.general import mask_iou, process_mask, process_mask_upsample, scale_image
@@ -88,19 +88,8 @@ def process_batch(detections, labels, iouv, pred_masks=None, gt_masks=None, over
     else:  # boxes
         iou = box_iou(labels[:, 1:], detections[:, :4])
 
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
     correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    return match_predictions(iou, correct_class, iouv)
 
 
 @smart_inference_mode()
@@ -256,7 +245,8 @@ def run(
                                         multi_label=True,
                                         agnostic=single_cls,
                                         max_det=max_det,
-                                        nm=nm)
+                                        nm=nm,
+                                        batched=True)
 
         # Metrics
         plot_masks = []  # masks for plotting
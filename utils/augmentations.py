@@ -75,6 +75,52 @@ def augment_hsv(im, hgain=0.5, sgain=0.5, vgain=0.5):
         cv2.cvtColor(im_hsv, cv2.COLOR_HSV2BGR, dst=im)  # no return needed
 
 
+def augment_hsv_batch(im, hgain=0.5, sgain=0.5, vgain=0.5):
+    # HSV color-space augmentation of uint8 RGB batch im(n,3,h,w) in place on its device, random gains drawn per image
+    if hgain or sgain or vgain:
+        n = im.shape[0]
+        r = (torch.rand(n, 3) * 2 - 1) * torch.tensor([hgain, sgain, vgain]) + 1  # random gains
+        r = r.view(n, 3, 1, 1).to(im.device)
+        x = im.float()
+        red, green, blue = x.unbind(1)
+        val = torch.maximum(torch.maximum(red, green), blue)
+        d = val - torch.minimum(torch.minimum(red, green), blue)  # chroma
+        hue = torch.where(val == red, green - blue, torch.where(val == green, blue - red + 2 * d, red - green + 4 * d))
+        sat = d / val.clamp(min=1)
+
+        hue.div_(d.clamp_(min=1E-6)).remainder_(6).mul_(r[:, 0]).remainder_(6)  # hue in sextants 0-6
+        val.mul_(r[:, 2]).clamp_(max=255)
+        d = sat.mul_(r[:, 1]).clamp_(max=1).mul_(val)  # augmented chroma
+
+        for i, k in enumerate((5, 3, 1)):  # HSV to RGB
+            k = (hue + k).remainder_(6)
+            x[:, i] = val - d * torch.minimum(k, 4 - k).clamp_(0, 1)
+        im.copy_(x.round_())  # no return needed
+
+
+def flip_batch(x, ud, lr):
+    # Flip batch x(n,...,h,w) in place, up-down where boolean ud(n) and left-right where boolean lr(n)
+    ud, lr = ud.to(x.device), lr.to(x.device)
+    if ud.any():
+        x[ud] = x[ud].flip(-2)
+    if lr.any():
+        x[lr] = x[lr].flip(-1)
+    return x
+
+
+def augment_batch(im, targets, hyp):
+    # HSV and flip augmentation of a collated uint8 RGB batch im(n,3,h,w) and its targets(m,6) [image,class,xywhn]
+    # Returns the per-image up-down and left-right flip flags so any masks can be flipped to match
+    n = im.shape[0]
+    augment_hsv_batch(im, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+    ud, lr = torch.rand(n) < hyp['flipud'], torch.rand(n) < hyp['fliplr']
+    flip_batch(im, ud, lr)
+    i = targets[:, 0].long()  # target image index
+    targets[:, 3] = torch.where(ud[i], 1 - targets[:, 3], targets[:, 3])
+    targets[:, 2] = torch.where(lr[i], 1 - targets[:, 2], targets[:, 2])
+    return ud, lr
+
+
 def hist_equalize(im, clahe=True, bgr=False):
     # Equalize histogram on BGR image 'im' with im.shape(n,m,3) and range 0-255
     yuv = cv2.cvtColor(im, cv2.COLOR_BGR2YUV if bgr else cv2.COLOR_RGB2YUV)
@@ -150,11 +196,31 @@ def random_perspective(im,
 
     height = im.shape[0] + border[0] * 2  # shape(h,w,c)
     width = im.shape[1] + border[1] * 2
+    M, s = random_perspective_matrix(im.shape, border, degrees, translate, scale, shear, perspective)
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
+    # ax[0].imshow(im[:, :, ::-1])  # base
+    # ax[1].imshow(im2[:, :, ::-1])  # warped
+
+    return im, warp_targets(targets, segments, M, s, width, height, perspective)
+
+
+def random_perspective_matrix(shape, border=(0, 0), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0):
+    # Random perspective matrix M for an image of shape(h,w) and its random scale s, as used by random_perspective()
+    height = shape[0] + border[0] * 2
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -im.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -im.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -180,20 +246,11 @@ def random_perspective(im,
     T[1, 2] = random.uniform(0.5 - translate, 0.5 + translate) * height  # y translation (pixels)
 
     # Combined rotation matrix
-    M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
-        if perspective:
-            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
-        else:  # affine
-            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+    return T @ S @ R @ P @ C, s  # order of operations (right to left) is IMPORTANT
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(im[:, :, ::-1])  # base
-    # ax[1].imshow(im2[:, :, ::-1])  # warped
 
-    # Transform label coordinates
+def warp_targets(targets, segments, M, s, width, height, perspective=0.0):
+    # Transform targets [cls, xyxy] (or their segments) by perspective matrix M into a (width, height) image
     n = len(targets)
     if n:
         use_segments = any(x.any() for x in segments)
@@ -229,7 +286,32 @@ def random_perspective(im,
         targets = targets[i]
         targets[:, 1:5] = new[i]
 
-    return im, targets
+    return targets
+
+
+def warp_tiles(tiles, M, dsize, perspective=0.0, border_value=114):
+    # Warp image tiles [(im, (x, y))] pasted at canvas offsets (x, y) through M straight into one dsize=(w, h) image,
+    # matching random_perspective() on the pasted canvas without materialising it
+    width, height = dsize
+    out = np.full((height, width, tiles[0][0].shape[2]), border_value, dtype=np.uint8)
+    for im, (x, y) in tiles:
+        h, w = im.shape[:2]
+        if not (h and w):
+            continue
+        Mt = M @ np.array([[1, 0, x], [0, 1, y], [0, 0, 1]])  # tile to output
+        xy = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]]) @ Mt.T  # tile corners
+        xy = xy[:, :2] / xy[:, 2:3]
+        x1, y1 = np.floor(xy.min(0)).clip(0, dsize).astype(int)  # output region covered by the tile
+        x2, y2 = (np.ceil(xy.max(0)) + 1).clip(0, dsize).astype(int)
+        if x2 <= x1 or y2 <= y1:  # warped out of frame
+            continue
+        Mt = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]]) @ Mt  # tile to output region
+        roi = out[y1:y2, x1:x2]  # written in place, edges blend with what is already there
+        if perspective:
+            cv2.warpPerspective(im, Mt, (x2 - x1, y2 - y1), dst=roi, borderMode=cv2.BORDER_TRANSPARENT)
+        else:  # affine
+            cv2.warpAffine(im, Mt[:2], (x2 - x1, y2 - y1), dst=roi, borderMode=cv2.BORDER_TRANSPARENT)
+    return out
 
 
 def copy_paste(im, labels, segments, p=0.5):
@@ -1,13 +1,19 @@
+import atexit
 import contextlib
 import glob
 import hashlib
 import json
 import math
+import mmap
 import os
 import random
 import shutil
+import struct
 import time
+import zlib
+from collections import OrderedDict
 from itertools import repeat
+from multiprocessing import resource_tracker, shared_memory
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
 from threading import Thread
@@ -23,8 +29,9 @@ from PIL import ExifTags, Image, ImageOps
 from torch.utils.data import DataLoader, Dataset, dataloader, distributed
 from tqdm import tqdm
 
-from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
-                                 letterbox, mixup, random_perspective)
+from utils.augmentations import (Albumentations, augment_batch, augment_hsv, classify_albumentations, classify_transforms,
+                                 copy_paste, letterbox, mixup, random_perspective, random_perspective_matrix,
+                                 warp_targets, warp_tiles)
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
                            check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
                            xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
@@ -37,6 +44,9 @@ VID_FORMATS = 'asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 't
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
 PIN_MEMORY = str(os.getenv('PIN_MEMORY', True)).lower() == 'true'  # global pin_memory for dataloaders
+DISK_CACHE_DIR = os.getenv('DISK_CACHE_DIR')  # optional scratch volume for --cache disk-z shards
+CACHE_ASYNC = str(os.getenv('CACHE_ASYNC', False)).lower() == 'true'  # cache images in the background
+MOSAIC_CACHE_MB = int(os.getenv('MOSAIC_CACHE_MB', 0))  # per-worker decoded mosaic tile cache size, 0 to disable
 
 # Get orientation exif tag
 for orientation in ExifTags.TAGS.keys():
@@ -52,6 +62,110 @@ def get_hash(paths):
     return h.hexdigest()  # return hash
 
 
+LABEL_CACHE_MAGIC = b'YOLOLBL\x00'  # columnar label *.cache file signature
+
+
+def save_label_cache(path, header, arrays):
+    # Save a columnar label cache: magic, header length, JSON header, then 64-byte aligned raw arrays
+    header, offset = dict(header, arrays={}), 0
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    for k, v in arrays.items():
+        header['arrays'][k] = {'dtype': v.dtype.str, 'shape': list(v.shape), 'offset': offset}
+        offset += -(-v.nbytes // 64) * 64  # align to 64 bytes
+    h = json.dumps(header).encode()
+    start = -(-(len(LABEL_CACHE_MAGIC) + 8 + len(h)) // 64) * 64  # data section offset
+    tmp = Path(path).with_name(Path(path).name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(LABEL_CACHE_MAGIC + struct.pack('<Q', len(h)) + h)
+        for k, v in arrays.items():
+            f.seek(start + header['arrays'][k]['offset'])
+            f.write(v.tobytes())
+    os.replace(tmp, path)  # atomic, readers never see a partial cache
+
+
+def load_label_cache(path, mmap_mode='c'):
+    # Load a columnar label cache, returns (header, arrays) with arrays memory-mapped copy-on-write
+    with open(path, 'rb') as f:
+        assert f.read(len(LABEL_CACHE_MAGIC)) == LABEL_CACHE_MAGIC, 'not a columnar label cache'
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n))
+    start = -(-(len(LABEL_CACHE_MAGIC) + 8 + n) // 64) * 64
+    arrays = {}
+    for k, v in header.pop('arrays').items():
+        shape = tuple(v['shape'])
+        if math.prod(shape):
+            arrays[k] = np.memmap(path, dtype=v['dtype'], mode=mmap_mode, offset=start + v['offset'], shape=shape)
+        else:  # zero-size arrays can not be mapped
+            arrays[k] = np.zeros(shape, dtype=v['dtype'])
+    return header, arrays
+
+
+def pack_labels(labels, shapes, segments):
+    # Pack per-image labels, shapes and segments into flat arrays plus offset indices
+    polygons = [s for x in segments for s in x]
+    return {
+        'shapes': np.array(shapes, dtype=np.int64).reshape(-1, 2),
+        'labels': np.concatenate(labels, 0).astype(np.float32) if labels else np.zeros((0, 5), np.float32),
+        'label_offsets': np.cumsum([0] + [len(x) for x in labels], dtype=np.int64),
+        'segments': np.concatenate(polygons, 0).astype(np.float32) if polygons else np.zeros((0, 2), np.float32),
+        'segment_offsets': np.cumsum([0] + [len(s) for s in polygons], dtype=np.int64),  # points per polygon
+        'segment_index': np.cumsum([0] + [len(x) for x in segments], dtype=np.int64)}  # polygons per image
+
+
+def unpack_labels(arrays):
+    # Split flat label cache arrays into per-image (labels, shapes, segments) views without copying
+    lo, so, si = (arrays[k].tolist() for k in ('label_offsets', 'segment_offsets', 'segment_index'))
+    lb, sg = arrays['labels'].view(np.ndarray), arrays['segments'].view(np.ndarray)
+    labels = [lb[i:j] for i, j in zip(lo[:-1], lo[1:])]
+    polygons = [sg[i:j] for i, j in zip(so[:-1], so[1:])]
+    segments = [polygons[i:j] for i, j in zip(si[:-1], si[1:])]
+    return labels, np.array(arrays['shapes']), segments
+
+
+MASK_DTYPES = 'uint8', 'int32', 'int64', 'float32', 'int16'  # mask cache dtypes
+
+
+def rle_encode(x):
+    # Run-length encode array x in row-major order, returns the (values, lengths) of its runs
+    x = x.ravel()
+    if not x.size:
+        return x, np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate(([True], x[1:] != x[:-1])))
+    return x[starts], np.diff(np.append(starts, x.size))
+
+
+def pack_masks(masks):
+    # Run-length encode a list of per-image tuples of mask arrays into flat arrays plus offset indices
+    x = [m for item in masks for m in item]
+    runs = [rle_encode(m) for m in x] or [(np.zeros(0), np.zeros(0))]
+    return {
+        'mask_values': np.concatenate([v for v, _ in runs]).astype(np.int32),
+        'mask_lengths': np.concatenate([n for _, n in runs]).astype(np.int32),
+        'mask_offsets': np.cumsum([0] + [len(v) for v, _ in runs[:len(x)]], dtype=np.int64),  # runs per mask array
+        'mask_shapes': np.array([(m.ndim, *m.shape, *(1,) * (3 - m.ndim)) for m in x], np.int64).reshape(-1, 4),
+        'mask_dtypes': np.array([MASK_DTYPES.index(m.dtype.name) for m in x], np.uint8)}
+
+
+def unpack_mask(arrays, i):
+    # Decode mask array i of pack_masks() arrays
+    j, k = arrays['mask_offsets'][i:i + 2]
+    ndim, *shape = arrays['mask_shapes'][i].tolist()
+    x = np.repeat(arrays['mask_values'][j:k], arrays['mask_lengths'][j:k])
+    return x.astype(MASK_DTYPES[arrays['mask_dtypes'][i]]).reshape(shape[:ndim])
+
+
+def file_stats(paths):
+    # Returns an (n, 2) int64 array of (mtime_ns, size) per path, (-1, -1) for missing paths
+    def stat(p):
+        try:
+            st = os.stat(p)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return -1, -1
+
+    return np.array([stat(p) for p in paths], dtype=np.int64).reshape(-1, 2)
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -112,7 +226,8 @@ def create_dataloader(path,
                       quad=False,
                       min_items=0,
                       prefix='',
-                      shuffle=False):
+                      shuffle=False,
+                      batch_augment=False):
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -131,6 +246,7 @@ def create_dataloader(path,
             image_weights=image_weights,
             min_items=min_items,
             prefix=prefix)
+    dataset.batch_augment = batch_augment and augment  # HSV and flips left to the training loop, see augment_batch()
 
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
@@ -427,9 +543,234 @@ def img2label_paths(img_paths):
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+class SharedImageCache:
+    """ RAM image cache in one shared memory arena, mapped by all DataLoader workers and local DDP ranks
+
+    The arena holds one 'filled' flag byte per image followed by the uint8 HWC images back to back. Offsets are
+    derived from the image shapes, so every process that knows the shapes can attach by name without an exchange.
+    """
+
+    def __init__(self, name, shapes, create=True, untrack=True):
+        self.name, self.shapes = name, np.asarray(shapes, dtype=np.int64).reshape(-1, 3)  # (n, 3) hwc
+        n, nbytes = len(self.shapes), self.shapes.prod(1)
+        self.offsets = n + np.concatenate(([0], np.cumsum(nbytes)[:-1])).astype(np.int64)
+        self.nbytes = int(n + nbytes.sum())
+        self.owner = False
+        if create:
+            with contextlib.suppress(FileExistsError):  # attach instead if another local rank created it
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=max(self.nbytes, 1))
+                self.owner = True
+                atexit.register(self.close)
+        if not self.owner:
+            self._attach(untrack and not create)  # an existing arena of this run is tracked by its creator
+        self.filled = np.ndarray((n,), dtype=np.uint8, buffer=self.shm.buf)
+
+    def _attach(self, untrack=True):
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        if untrack:  # only the owner may unlink, see https://bugs.python.org/issue39959
+            with contextlib.suppress(Exception):
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, i):
+        # Returns cached image i as a view into the arena, or None if not cached yet
+        if not self.filled[i]:
+            return None
+        return np.ndarray(self.shapes[i], dtype=np.uint8, buffer=self.shm.buf, offset=self.offsets[i])
+
+    def __setitem__(self, i, im):
+        # Copies image i into the arena, images that do not match the reserved shape are left uncached
+        if im.shape == tuple(self.shapes[i]) and im.dtype == np.uint8:
+            np.ndarray(self.shapes[i], dtype=np.uint8, buffer=self.shm.buf, offset=self.offsets[i])[:] = im
+            self.filled[i] = 1
+
+    def __getstate__(self):
+        # Spawned workers re-attach by name instead of pickling the arena
+        return {'name': self.name, 'shapes': self.shapes}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['shapes'], create=False, untrack=False)  # shares the owner's tracker
+
+    def close(self):
+        # Release this process's mapping, the owner also removes the arena name
+        with contextlib.suppress(Exception):
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+
+
+class CompressedImageCache:
+    """ Disk image cache of resized images, zlib compressed and appended to a few large shard files
+
+    An index.cache file (see save_label_cache()) maps each image to (shard, offset, length, h, w, c) for random
+    access, shards are memory-mapped read-only on first use in each process. The index is checkpointed while the
+    cache is built, so an interrupted build resumes and readers pick up images cached so far.
+    """
+    version = 1.0  # index version
+    shard_size = 1 << 30  # start a new shard after 1GB
+    refresh_interval = 10.0  # seconds between index reloads while the cache is incomplete
+
+    def __init__(self, path, header):
+        self.dir, self.header = Path(path), dict(header, version=self.version, codec='zlib')
+        self.index_file = self.dir / 'index.cache'
+        self.shards = {}  # shard number: mmap, per process
+        self.writer, self.pid, self.refreshed = None, None, time.time()  # pid of the process owning the writer
+        self.index, self.complete = self.load_index()
+
+    def load_index(self):
+        # Returns (index, complete) from index.cache, or an empty index if missing or built for other settings
+        try:
+            cache, arrays = load_label_cache(self.index_file, mmap_mode='r')
+            complete = cache.pop('complete')
+            assert cache == self.header  # same version, files and resize settings
+            return np.array(arrays['index']), complete
+        except Exception:
+            return np.full((len(self.header['files']), 6), -1, dtype=np.int64), False
+
+    @staticmethod
+    def encode(im):
+        # Compress a uint8 image, level 1 trades a slightly larger file for several times faster compression
+        return zlib.compress(np.ascontiguousarray(im), 1)
+
+    def add(self, i, blob, shape):
+        # Append compressed image i to the current shard, returns its size in bytes
+        if self.writer is None:
+            k = int(self.index[:, 0].max())  # last shard of a checkpoint, -1 if none
+            if k < 0:  # start a fresh cache
+                self.dir.mkdir(parents=True, exist_ok=True)
+                for f in self.dir.glob('*'):
+                    f.unlink()
+            k = max(k, 0)
+            self.writer, self.pid = [k, open(self.dir / f'shard_{k:03d}.bin', 'ab')], os.getpid()
+        k, f = self.writer
+        if f.tell() + len(blob) > self.shard_size and f.tell():
+            f.close()
+            k, f = k + 1, open(self.dir / f'shard_{k + 1:03d}.bin', 'ab')
+            self.writer = [k, f]
+        offset = f.tell()
+        f.write(blob)
+        f.flush()  # readers in this and forked processes may use the index entry at once
+        self.index[i] = k, offset, len(blob), *shape
+        return len(blob)
+
+    def save(self):
+        # Write the index, a checkpoint while images are missing, else close the current shard
+        if self.writer is not None:
+            self.writer[1].flush()  # index entries must never point past flushed data
+        self.complete = bool((self.index[:, 0] >= 0).all())
+        if self.complete and self.writer is not None:
+            self.writer[1].close()
+            self.writer = None
+        save_label_cache(self.index_file, dict(self.header, complete=self.complete), {'index': self.index})
+
+    def refresh(self):
+        # Merge images checkpointed by the process building this cache into the index of a reading process
+        self.refreshed = time.time()
+        index, self.complete = self.load_index()
+        self.index = np.where(self.index[:, :1] >= 0, self.index, index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        # Returns decompressed image i, or None if it is not cached
+        if self.index[i, 0] < 0 and not self.complete and (self.writer is None or self.pid != os.getpid()) and \
+                time.time() - self.refreshed > self.refresh_interval:  # not the writing process, e.g. forked workers
+            self.refresh()
+        k, offset, length, *shape = self.index[i].tolist()
+        if k < 0:
+            return None
+        m = self.shards.get(k)
+        if m is None or offset + length > len(m):  # not mapped yet, or shard grew since it was mapped
+            if m is not None:
+                self.shards.pop(k).close()
+            m = self.map(k)
+            if m is None or offset + length > len(m):  # not on disk yet, decode on demand
+                return None
+        buf = zlib.decompress(m[offset:offset + length])
+        return np.frombuffer(buf, dtype=np.uint8).reshape(shape).copy()  # writeable, like cv2.imread()
+
+    def map(self, k):
+        # Memory-maps shard k read-only, None if it is still empty
+        with open(self.dir / f'shard_{k:03d}.bin', 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            self.shards[k] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shards[k]
+
+    def __getstate__(self):
+        # Spawned workers map the shards again on first use
+        return {k: v for k, v in self.__dict__.items() if k not in ('shards', 'writer')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, shards={}, writer=None)
+
+
+class TileCache:
+    """ LRU of decoded, resized images kept by each DataLoader worker for mosaic and mixup tiles
+
+    Bounded by max_bytes per worker. Hit/miss counters are shared memory tensors, one row per worker, so the
+    training process can log totals over all workers.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes, self.bytes, self.tiles = max_bytes, 0, OrderedDict()  # index: (im, hw_orig, hw_resized)
+        self.stats = torch.zeros((64, 2), dtype=torch.int64).share_memory_()  # (worker, [hits, misses])
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def _row(self):
+        info = torch.utils.data.get_worker_info()
+        return info.id % len(self.stats) if info else 0
+
+    def get(self, i):
+        x = self.tiles.get(i)
+        if x is None:
+            self.stats[self._row(), 1] += 1
+        else:
+            self.tiles.move_to_end(i)
+            self.stats[self._row(), 0] += 1
+        return x
+
+    def put(self, i, x):
+        if x[0].nbytes > self.max_bytes:
+            return
+        self.tiles[i] = x
+        self.bytes += x[0].nbytes
+        while self.bytes > self.max_bytes:  # evict least recently used
+            self.bytes -= self.tiles.popitem(last=False)[1][0].nbytes
+
+    def log(self, prefix=''):
+        # Log and reset hit/miss counters summed over all workers
+        hits, misses = self.stats.sum(0).tolist()
+        self.stats.zero_()
+        LOGGER.info(f'{prefix}Mosaic tile cache: {hits} hits, {misses} misses '
+                    f'({hits / max(hits + misses, 1):.1%} hit rate, {self.max_bytes / (1 << 20):.0f}MB per worker)')
+
+
+WARMUP_DATASET = None  # dataset of an image cache warmup process, see LoadImagesAndLabels.warmup_cache()
+
+
+def warmup_worker_init(dataset):
+    # Pool initializer, hands the dataset to each warmup process once rather than with every task
+    global WARMUP_DATASET
+    WARMUP_DATASET = dataset
+
+
+def warmup_worker(args):
+    # Cache one image in a warmup process, returns (index, LoadImagesAndLabels.cache_image() result)
+    i, mode = args
+    return i, WARMUP_DATASET.cache_image(i, mode)
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.8  # dataset labels *.cache version
+    mask_cache_version = 0.3  # dataset masks *_masks.cache version
+    batch_augment = False  # HSV and flips applied to whole batches by augment_batch() instead of per image
     rand_interp_methods = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_LANCZOS4]
 
     def __init__(self,
@@ -481,31 +822,29 @@ class LoadImagesAndLabels(Dataset):
         # Check cache
         self.label_files = img2label_paths(self.im_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
-        try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
-            assert cache['version'] == self.cache_version  # matches current version
-            assert cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
-        except Exception:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # run cache ops
+        cache, arrays, exists = self.check_cache_labels(cache_path, self.label_files, prefix)
+        self.cache_path = cache_path
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupt, total
         if exists and LOCAL_RANK in {-1, 0}:
             d = f"Scanning {cache_path}... {nf} images, {nm + ne} backgrounds, {nc} corrupt"
             tqdm(None, desc=prefix + d, total=n, initial=n, bar_format=TQDM_BAR_FORMAT)  # display cache results
-            if cache['msgs']:
-                LOGGER.info('\n'.join(cache['msgs']))  # display warnings
+            msgs = [x for x in cache['msgs'] if x]
+            if msgs:
+                LOGGER.info('\n'.join(msgs))  # display warnings
         assert nf > 0 or not augment, f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        labels, shapes, self.segments = zip(*cache.values())
-        nl = len(np.concatenate(labels, 0))  # number of labels
+        include = np.flatnonzero(arrays['file_results'][:, 3] == 0)  # drop corrupt images
+        labels, shapes, segments = unpack_labels(arrays)
+        nl = len(arrays['labels'])  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
-        self.labels = list(labels)
-        self.shapes = np.array(shapes)
-        self.im_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.labels = [labels[i] for i in include]
+        self.shapes = shapes[include]
+        self.segments = [segments[i] for i in include]
+        self.im_files = [self.im_files[i] for i in include]  # update
+        self.label_files = img2label_paths(self.im_files)  # update
 
         # Filter images
         if min_items:
@@ -563,79 +902,224 @@ class LoadImagesAndLabels(Dataset):
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
         # Cache images into RAM/disk for faster training
-        if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
-            cache_images = False
+        hw0 = self.shapes[:, ::-1]  # original hw
+        r = self.img_size / hw0.max(1, keepdims=True)  # resize ratio
+        self.im_hw0 = [tuple(x) for x in hw0.tolist()]
+        self.im_hw = [tuple(x) for x in np.where(r != 1, hw0 * r, hw0).astype(int).tolist()]  # as in load_image()
         self.ims = [None] * n
         self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
+        if cache_images == 'ram':
+            shared = self.shared_image_cache(prefix)
+            if shared is not None:
+                self.ims = shared
+            if shared is None or not shared.owner:  # not caching, or filled by local rank 0
+                cache_images = False
+        elif cache_images == 'disk-z':
+            self.ims = CompressedImageCache(self.compressed_cache_dir(cache_path), {
+                'files': self.im_files,
+                'img_size': self.img_size,
+                'augment': self.augment})  # resize interpolation depends on augment
+            if self.ims.complete or LOCAL_RANK > 0:  # already cached, or cached by local rank 0
+                cache_images = False
+        self.tile_cache = None  # set after warmup so warmup processes do not fill it
         if cache_images:
-            b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-            self.im_hw0, self.im_hw = [None] * n, [None] * n
-            fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
-            results = ThreadPool(NUM_THREADS).imap(fcn, range(n))
-            pbar = tqdm(enumerate(results), total=n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+            self.warmup_cache(cache_images, prefix)
+        if self.mosaic and MOSAIC_CACHE_MB > 0 and cache_images != 'ram':
+            self.tile_cache = TileCache(MOSAIC_CACHE_MB << 20)
+
+    def warmup_cache(self, mode, prefix=''):
+        # Cache images not cached yet with a process pool. With CACHE_ASYNC=True this runs in the background and
+        # overlaps the first epoch, during which uncached images are decoded on demand
+        if mode == 'disk':
+            todo = [i for i, f in enumerate(self.npy_files) if not f.exists()]
+        elif mode == 'disk-z':
+            todo = np.flatnonzero(self.ims.index[:, 0] < 0).tolist()  # resume from the last checkpoint
+        else:  # 'ram'
+            todo = np.flatnonzero(self.ims.filled == 0).tolist()
+        if len(todo) < self.n:
+            LOGGER.info(f'{prefix}Resuming image cache, {self.n - len(todo)}/{self.n} images already cached')
+        pool = Pool(NUM_THREADS, initializer=warmup_worker_init, initargs=(self,))
+        results = pool.imap_unordered(warmup_worker, zip(todo, repeat(mode)), chunksize=4)
+        if CACHE_ASYNC:
+            Thread(target=self.warmup_results, args=(pool, results, mode, len(todo), prefix), daemon=True).start()
+        else:
+            self.warmup_results(pool, results, mode, len(todo), prefix)
+
+    def warmup_results(self, pool, results, mode, n, prefix=''):
+        # Collect warmup results, appending 'disk-z' images to their shards and checkpointing the index
+        b, gb, t = 0, 1 << 30, time.time()  # bytes of cached images, bytes per gigabytes, last checkpoint
+        pbar = tqdm(results, total=n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0 or CACHE_ASYNC)
+        try:
             for i, x in pbar:
-                if cache_images == 'disk':
-                    b += self.npy_files[i].stat().st_size
-                else:  # 'ram'
-                    self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache_images})'
+                if mode == 'disk-z':
+                    x = self.ims.add(i, *x)
+                    if time.time() - t > 30:
+                        self.ims.save()  # resumable checkpoint
+                        t = time.time()
+                b += x
+                pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {mode})'
+        finally:
             pbar.close()
+            pool.terminate()
+            if mode == 'disk-z':
+                self.ims.save()
+        if CACHE_ASYNC:
+            LOGGER.info(f'{prefix}Cached {n} images in the background ({b / gb:.1f}GB {mode})')
+
+    def cache_masks(self, polygons, prefix=''):
+        # Rasterize the masks of every image once with self.rasterize(i), as __getitem__() would without augmentation.
+        # Stored run-length encoded beside the label cache and reused while the polygons and settings are unchanged
+        path = self.cache_path.with_name(f'{self.cache_path.stem}_masks.cache')
+        settings = [type(self).__name__, self.img_size, self.downsample_ratio, self.overlap, self.im_files]
+        h = hashlib.md5(json.dumps(settings + [self.batch_shapes.tolist() if self.rect else None]).encode())
+        for x in polygons:  # per image lists of polygons
+            for p in x:
+                for q in p:
+                    h.update(q.tobytes())
+        with contextlib.suppress(Exception):
+            header, arrays = load_label_cache(path)
+            if header['version'] == self.mask_cache_version and header['hash'] == h.hexdigest():
+                return arrays  # unchanged
+        with ThreadPool(NUM_THREADS) as pool:
+            masks = list(
+                tqdm(pool.imap(self.rasterize, range(self.n)),
+                     desc=f'{prefix}Caching masks',
+                     total=self.n,
+                     bar_format=TQDM_BAR_FORMAT,
+                     disable=LOCAL_RANK > 0))
+        arrays = pack_masks(masks)
+        try:
+            save_label_cache(path, {'version': self.mask_cache_version, 'hash': h.hexdigest()}, arrays)
+            LOGGER.info(f'{prefix}New cache created: {path}')
+        except Exception as e:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
+        return arrays
+
+    def letterbox_shape(self, i):
+        # Returns the (shape, ratio, pad) that letterbox() gives image i in __getitem__() without mosaic
+        h, w = self.im_hw[i]
+        shape = self.batch_shapes[self.batch[i]] if self.rect else self.img_size  # final letterboxed shape
+        if isinstance(shape, int):
+            shape = (shape, shape)
+        r = min(shape[0] / h, shape[1] / w)
+        if not self.augment:  # letterbox(scaleup=False)
+            r = min(r, 1.0)
+        dw, dh = shape[1] - int(round(w * r)), shape[0] - int(round(h * r))  # wh padding
+        return (int(shape[0]), int(shape[1])), (r, r), (dw / 2, dh / 2)
+
+    def compressed_cache_dir(self, cache_path):
+        # Returns the --cache disk-z directory, next to the labels *.cache or under DISK_CACHE_DIR if set
+        name = f"{cache_path.stem}_{self.img_size}{'_augment' if self.augment else ''}.zcache"
+        if DISK_CACHE_DIR:  # scratch volume, keep datasets with the same labels dir name apart
+            return Path(DISK_CACHE_DIR) / f'{hashlib.md5(str(cache_path).encode()).hexdigest()[:8]}_{name}'
+        return cache_path.parent / name
+
+    def shared_image_cache(self, prefix=''):
+        # Create (local rank 0) or attach (other local ranks) the shared RAM image cache, None if unavailable
+        shapes = [(h, w, 3) for h, w in self.im_hw]
+        key = [self.img_size, self.augment, os.getenv('MASTER_PORT', os.getpid()), *self.im_files]
+        name = 'yolo_' + hashlib.md5(str(key).encode()).hexdigest()[:16]  # same on all ranks of one run
+        try:
+            if LOCAL_RANK > 0:  # local rank 0 has already created and filled it
+                return SharedImageCache(name, shapes, create=False)
+            if self.check_cache_ram(prefix=prefix):
+                return SharedImageCache(name, shapes)
+        except FileNotFoundError:  # local rank 0 is not caching
+            pass
+        except Exception as e:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ Shared RAM cache unavailable, not caching images: {e}')
+        return None
 
     def check_cache_ram(self, safety_margin=0.1, prefix=''):
-        # Check image caching requirements vs available memory
-        b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-        n = min(self.n, 30)  # extrapolate from 30 random images
-        for _ in range(n):
-            im = cv2.imread(random.choice(self.im_files))  # sample image
-            ratio = self.img_size / max(im.shape[0], im.shape[1])  # max(h, w)  # ratio
-            b += im.nbytes * ratio ** 2
-        mem_required = b * self.n / n  # GB required to cache dataset into RAM
+        # Check image caching requirements vs available memory. The RAM cache is shared by all DataLoader workers
+        # and local DDP ranks, so it is counted once per host against RAM and the shared memory mount
+        gb = 1 << 30  # bytes per gigabytes
+        mem_required = sum(h * w * 3 for h, w in self.im_hw)  # bytes required to cache dataset into RAM
         mem = psutil.virtual_memory()
-        cache = mem_required * (1 + safety_margin) < mem.available  # to cache or not to cache, that is the question
+        available = mem.available
+        if os.path.isdir('/dev/shm'):  # Linux shared memory is backed by a (possibly size-limited) tmpfs
+            available = min(available, shutil.disk_usage('/dev/shm').free)
+        cache = mem_required * (1 + safety_margin) < available  # to cache or not to cache, that is the question
         if not cache:
             LOGGER.info(f"{prefix}{mem_required / gb:.1f}GB RAM required, "
-                        f"{mem.available / gb:.1f}/{mem.total / gb:.1f}GB available, "
+                        f"{available / gb:.1f}/{mem.total / gb:.1f}GB available, "
                         f"{'caching images ✅' if cache else 'not caching images ⚠️'}")
         return cache
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
+    def check_cache_labels(self, path, label_files, prefix=''):
+        # Load *.cache if every image/label file is unchanged, else refresh it. Returns (cache, arrays, exists)
+        stats = np.concatenate((file_stats(self.im_files), file_stats(label_files)), 1)  # (n, 4) mtime, size
+        try:
+            cache, arrays = load_label_cache(path)  # memory-mapped, shared across workers
+            assert cache['version'] == self.cache_version  # matches current version
+        except Exception:
+            cache, arrays = None, None
+        if cache and cache['files'] == self.im_files and np.array_equal(arrays['file_stats'], stats):
+            return cache, arrays, True
+        return (*self.cache_labels(path, prefix, label_files, stats, cache, arrays), False)  # run cache ops
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', label_files=None, stats=None, cache=None,
+                     arrays=None):
+        # Cache dataset labels, check images and read shapes. Entries of a previous cache are reused for
+        # image/label pairs whose (mtime, size) are unchanged, only new or modified files are verified again
+        label_files = label_files or self.label_files
+        if stats is None:
+            stats = np.concatenate((file_stats(self.im_files), file_stats(label_files)), 1)
+        n = len(self.im_files)
+        labels, shapes, segments = [np.zeros((0, 5), np.float32)] * n, [(0, 0)] * n, [[]] * n
+        results, msgs = np.zeros((n, 4), dtype=np.int64), [''] * n  # per file (missing, found, empty, corrupt)
+
+        # Reuse unchanged entries
+        reused = np.zeros(n, dtype=bool)
+        if cache:
+            index = {f: i for i, f in enumerate(cache['files'])}
+            j = np.array([index.get(f, -1) for f in self.im_files], dtype=np.int64)
+            reused = (j >= 0) & (arrays['file_stats'][j] == stats).all(1)
+            lb, sh, sg = unpack_labels(arrays)
+            for i in np.flatnonzero(reused):
+                labels[i], shapes[i], segments[i] = lb[j[i]], sh[j[i]], sg[j[i]]
+                results[i], msgs[i] = arrays['file_results'][j[i]], cache['msgs'][j[i]]
+        todo = np.flatnonzero(~reused)
+        nr = n - len(todo)  # number reused
+
+        nm, nf, ne, nc = results.sum(0).tolist()  # number missing, found, empty, corrupt
         desc = f"{prefix}Scanning {path.parent / path.stem}..."
         with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.label_files, repeat(prefix))),
+            pbar = tqdm(pool.imap(verify_image_label,
+                                  zip((self.im_files[i] for i in todo), (label_files[i] for i in todo), repeat(prefix))),
                         desc=desc,
-                        total=len(self.im_files),
+                        total=n,
+                        initial=nr,
                         bar_format=TQDM_BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
+            for i, (im_file, lb, shape, segs, nm_f, nf_f, ne_f, nc_f, msg) in zip(todo, pbar):
                 nm += nm_f
                 nf += nf_f
                 ne += ne_f
                 nc += nc_f
                 if im_file:
-                    x[im_file] = [lb, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt"
+                    labels[i], shapes[i], segments[i] = lb, shape, segs
+                results[i], msgs[i] = (nm_f, nf_f, ne_f, nc_f), msg
+                pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt, {nr} reused"
 
         pbar.close()
-        if msgs:
-            LOGGER.info('\n'.join(msgs))
+        if any(msgs):
+            LOGGER.info('\n'.join(x for x in msgs if x))
         if nf == 0:
             LOGGER.warning(f'{prefix}WARNING ⚠️ No labels found in {path}. {HELP_URL}')
-        x['hash'] = get_hash(self.label_files + self.im_files)
-        x['results'] = nf, nm, ne, nc, len(self.im_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
+        cache = {
+            'version': self.cache_version,  # cache version
+            'results': (nf, nm, ne, nc, n),
+            'msgs': msgs,  # per file warnings
+            'files': self.im_files}
+        arrays = pack_labels(labels, shapes, segments)
+        arrays['file_stats'] = stats  # image and label (mtime_ns, size)
+        arrays['file_results'] = results
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
-            LOGGER.info(f'{prefix}New cache created: {path}')
+            save_label_cache(path, cache, arrays)  # save cache for next time
+            LOGGER.info(f'{prefix}New cache created: {path} ({nr}/{n} entries reused)')
         except Exception as e:
             LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
-        return x
+        return cache, arrays
 
     def __len__(self):
         return len(self.im_files)
@@ -691,6 +1175,7 @@ class LoadImagesAndLabels(Dataset):
             img, labels = self.albumentations(img, labels)
             nl = len(labels)  # update after albumentations
 
+        if self.augment and not self.batch_augment:
             # HSV color-space
             augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
@@ -720,22 +1205,37 @@ class LoadImagesAndLabels(Dataset):
 
         return torch.from_numpy(img), labels_out, self.im_files[index], shapes
 
+    def augment_batch(self, im, targets):
+        # HSV and flip augmentation of a collated uint8 batch in place on its device, for batch_augment datasets
+        augment_batch(im, targets, self.hyp)
+
     def load_image(self, i):
         # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw)
-        im, f, fn = self.ims[i], self.im_files[i], self.npy_files[i],
-        if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-                assert im is not None, f'Image Not Found {f}'
-            h0, w0 = im.shape[:2]  # orig hw
-            r = self.img_size / max(h0, w0)  # ratio
-            if r != 1:  # if sizes are not equal
-                interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
-                im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
-            return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
-        return self.ims[i], self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
+        im = self.ims[i]
+        if im is not None:  # cached in RAM or disk-z
+            return im, self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
+        if self.tile_cache is None:
+            return self.read_image(i)
+        x = self.tile_cache.get(i)  # recently decoded by this worker
+        if x is None:
+            x = self.read_image(i)
+            self.tile_cache.put(i, x)
+        return x
+
+    def read_image(self, i):
+        # Reads 1 image from its *.npy or image file and resizes it, returns (im, original hw, resized hw)
+        f, fn = self.im_files[i], self.npy_files[i]
+        if fn.exists():  # load npy
+            im = np.load(fn)
+        else:  # read image
+            im = cv2.imread(f)  # BGR
+            assert im is not None, f'Image Not Found {f}'
+        h0, w0 = im.shape[:2]  # orig hw
+        r = self.img_size / max(h0, w0)  # ratio
+        if r != 1:  # if sizes are not equal
+            interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
+            im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
 
     def cache_images_to_disk(self, i):
         # Saves an image as an *.npy file for faster loading
@@ -743,9 +1243,20 @@ class LoadImagesAndLabels(Dataset):
         if not f.exists():
             np.save(f.as_posix(), cv2.imread(self.im_files[i]))
 
+    def cache_image(self, i, mode):
+        # Caches image i, returns bytes cached ('ram', 'disk') or the compressed image and its shape ('disk-z')
+        if mode == 'disk':
+            self.cache_images_to_disk(i)
+            return self.npy_files[i].stat().st_size
+        im = self.load_image(i)[0]  # resized as cached
+        if mode == 'disk-z':
+            return CompressedImageCache.encode(im), im.shape
+        self.ims[i] = im  # shared memory arena, visible to every process
+        return im.nbytes
+
     def load_mosaic(self, index):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
-        labels4, segments4 = [], []
+        labels4, segments4, tiles = [], [], []
         s = self.img_size
         yc, xc = (int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border)  # mosaic center x, y
         indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -756,7 +1267,6 @@ class LoadImagesAndLabels(Dataset):
 
             # place img in img4
             if i == 0:  # top left
-                img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
                 x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
                 x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
             elif i == 1:  # top right
@@ -769,7 +1279,7 @@ class LoadImagesAndLabels(Dataset):
                 x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
                 x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-            img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+            tiles.append((img[y1b:y2b, x1b:x2b], (x1a, y1a)))  # img4[ymin:ymax, xmin:xmax]
             padw = x1a - x1b
             padh = y1a - y1b
 
@@ -788,16 +1298,32 @@ class LoadImagesAndLabels(Dataset):
         # img4, labels4 = replicate(img4, labels4)  # replicate
 
         # Augment
-        img4, labels4, segments4 = copy_paste(img4, labels4, segments4, p=self.hyp['copy_paste'])
-        img4, labels4 = random_perspective(img4,
-                                           labels4,
-                                           segments4,
-                                           degrees=self.hyp['degrees'],
-                                           translate=self.hyp['translate'],
-                                           scale=self.hyp['scale'],
-                                           shear=self.hyp['shear'],
-                                           perspective=self.hyp['perspective'],
-                                           border=self.mosaic_border)  # border to remove
+        hyp = self.hyp
+        if hyp['copy_paste'] and segments4:  # copy-paste needs the full mosaic canvas
+            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            for im, (x, y) in tiles:
+                img4[y:y + im.shape[0], x:x + im.shape[1]] = im
+            img4, labels4, segments4 = copy_paste(img4, labels4, segments4, p=hyp['copy_paste'])
+            img4, labels4 = random_perspective(img4,
+                                               labels4,
+                                               segments4,
+                                               degrees=hyp['degrees'],
+                                               translate=hyp['translate'],
+                                               scale=hyp['scale'],
+                                               shear=hyp['shear'],
+                                               perspective=hyp['perspective'],
+                                               border=self.mosaic_border)  # border to remove
+        else:  # warp each tile straight into the output, drawing M exactly as random_perspective() would
+            M, scale = random_perspective_matrix((s * 2, s * 2),
+                                                 border=self.mosaic_border,
+                                                 degrees=hyp['degrees'],
+                                                 translate=hyp['translate'],
+                                                 scale=hyp['scale'],
+                                                 shear=hyp['shear'],
+                                                 perspective=hyp['perspective'])
+            size = s * 2 + self.mosaic_border[1] * 2, s * 2 + self.mosaic_border[0] * 2  # output width, height
+            img4 = warp_tiles(tiles, M, size, perspective=hyp['perspective'])
+            labels4 = warp_targets(labels4, segments4, M, scale, *size, perspective=hyp['perspective'])
 
         return img4, labels4
 
@@ -768,6 +768,18 @@ def xywh2xyxy(x):
     return y
 
 
+def pack_targets(targets, batch_size, scale_tensor):
+    # Pack (n, 6) [image, class, x, y, w, h] targets into (batch_size, max_n, 5) [class, x1, y1, x2, y2], zero padded
+    if targets.shape[0] == 0:
+        return torch.zeros(batch_size, 0, 5, device=targets.device)
+    i, order = targets[:, 0].long().sort(stable=True)  # keep the label order within each image
+    j = torch.arange(len(i), device=i.device) - torch.searchsorted(i, i)  # position within its image
+    out = torch.zeros(batch_size, int(j.max()) + 1, 5, device=targets.device)
+    out[i, j] = targets[order, 1:].float()
+    out[..., 1:5] = xywh2xyxy(out[..., 1:5].mul_(scale_tensor))
+    return out
+
+
 def xywhn2xyxy(x, w=640, h=640, padw=0, padh=0):
     # Convert nx4 boxes from [x, y, w, h] normalized to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
     y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
@@ -892,6 +904,7 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        batched=False,  # one NMS call for the whole batch
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
@@ -924,6 +937,10 @@ def non_max_suppression(
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
+    if batched:
+        return non_max_suppression_batched(prediction, xc, conf_thres, iou_thres, classes, agnostic, multi_label,
+                                           labels, max_det, nm, max_wh, max_nms, device)
+
     t = time.time()
     output = [torch.zeros((0, 6 + nm), device=prediction.device)] * bs
     for xi, x in enumerate(prediction):  # image index, image inference
@@ -994,6 +1011,68 @@ def non_max_suppression(
     return output
 
 
+def non_max_suppression_batched(prediction, xc, conf_thres, iou_thres, classes, agnostic, multi_label, labels, max_det,
+                                nm, max_wh, max_nms, device):
+    # non_max_suppression(batched=True): candidates of all images are flattened and offset by (image, class) so that a
+    # single torchvision.ops.nms() call covers the batch. Output matches the per-image loop, without time_limit or merge
+    bs, nc = prediction.shape[0], prediction.shape[1] - nm - 4
+    bi, ai = xc.nonzero(as_tuple=True)  # image, anchor of each candidate
+    x = prediction.transpose(1, 2)[bi, ai]
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        lb = torch.cat([lb.to(x.device) for lb in labels])
+        v = torch.zeros((len(lb), nc + nm + 4), device=x.device)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[range(len(lb)), lb[:, 0].long() + 4] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        bi = torch.cat((bi, torch.arange(bs, device=x.device).repeat_interleave(
+            torch.tensor([len(lb) for lb in labels], device=x.device))))
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    box, cls, mask = x.split((4, nc, nm), 1)
+    box = xywh2xyxy(box)
+    if multi_label:
+        i, j = (cls > conf_thres).nonzero(as_tuple=False).T
+        x, bi = torch.cat((box[i], x[i, 4 + j, None], j[:, None].float(), mask[i]), 1), bi[i]
+    else:  # best class only
+        conf, j = cls.max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, bi = torch.cat((box, conf, j.float(), mask), 1)[i], bi[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, bi = x[i], bi[i]
+
+    # Sort by image, then confidence, and keep the max_nms most confident boxes of each image
+    i = x[:, 4].argsort(descending=True)
+    i = i[bi[i].sort(stable=True)[1]]
+    x, bi = x[i], bi[i]
+    n = torch.bincount(bi, minlength=bs)
+    i = torch.arange(len(bi), device=x.device) < (n.cumsum(0) - n + max_nms)[bi]
+    x, bi = x[i], bi[i]
+    n = n.clamp(max=max_nms)
+
+    # Batched NMS, float64 as image * class offsets exceed the float32 mantissa. NMS is quadratic in the number of boxes,
+    # so consecutive images are packed into calls of up to the torchvision.ops.batched_nms() offset budget, and only an
+    # image with more candidates than that gets a call of its own
+    c = bi if agnostic else bi * nc + x[:, 5].long()  # one offset per image (and class)
+    boxes, scores = x[:, :4].double() + c[:, None] * max_wh, x[:, 4].double()  # boxes (offset), scores
+    budget = 1000 if x.device.type == 'cpu' else 5000  # boxes per NMS call
+    keep, start, end = [], 0, 0
+    for k in n.tolist() + [budget + 1]:
+        if end + k - start > budget and end > start:
+            keep.append(torchvision.ops.nms(boxes[start:end], scores[start:end], iou_thres) + start)  # NMS
+            start = end
+        end += k
+    i = torch.cat(keep) if keep else bi[:0]
+    i = i[bi[i].sort(stable=True)[1]]  # by image, then descending score
+    n = torch.bincount(bi[i], minlength=bs)
+    i = i[torch.arange(len(i), device=x.device) < (n.cumsum(0) - n + max_det)[bi[i]]]  # limit detections
+    return [xi.to(device) for xi in x[i].split(n.clamp(max=max_det).tolist())]
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
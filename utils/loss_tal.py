@@ -4,9 +4,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from utils.general import xywh2xyxy
+from utils.general import pack_targets
 from utils.metrics import bbox_iou
-from utils.tal.anchor_generator import dist2bbox, make_anchors, bbox2dist
+from utils.tal.anchor_generator import anchor_levels, dist2bbox, make_anchors, bbox2dist
 from utils.tal.assigner import TaskAlignedAssigner
 from utils.torch_utils import de_parallel
 
@@ -66,41 +66,32 @@ class BboxLoss(nn.Module):
         self.use_dfl = use_dfl
 
     def forward(self, pred_dist, pred_bboxes, anchor_points, target_bboxes, target_scores, target_scores_sum, fg_mask):
-        # iou loss
-        bbox_mask = fg_mask.unsqueeze(-1).repeat([1, 1, 4])  # (b, h*w, 4)
-        pred_bboxes_pos = torch.masked_select(pred_bboxes, bbox_mask).view(-1, 4)
-        target_bboxes_pos = torch.masked_select(target_bboxes, bbox_mask).view(-1, 4)
-        bbox_weight = torch.masked_select(target_scores.sum(-1), fg_mask).unsqueeze(-1)
-        
-        iou = bbox_iou(pred_bboxes_pos, target_bboxes_pos, xywh=False, CIoU=True)
-        loss_iou = 1.0 - iou
+        # gather the positive anchors once, CIoU and DFL then run over the packed (n, ...) tensors
+        b, a = fg_mask.nonzero(as_tuple=True)
+        target_bboxes_pos = target_bboxes[b, a]
+        bbox_weight = target_scores[b, a].sum(-1, keepdim=True)
 
-        loss_iou *= bbox_weight
-        loss_iou = loss_iou.sum() / target_scores_sum
+        # iou loss
+        iou = bbox_iou(pred_bboxes[b, a], target_bboxes_pos, xywh=False, CIoU=True)
+        loss_iou = ((1.0 - iou) * bbox_weight).sum() / target_scores_sum
 
         # dfl loss
         if self.use_dfl:
-            dist_mask = fg_mask.unsqueeze(-1).repeat([1, 1, (self.reg_max + 1) * 4])
-            pred_dist_pos = torch.masked_select(pred_dist, dist_mask).view(-1, 4, self.reg_max + 1)
-            target_ltrb = bbox2dist(anchor_points, target_bboxes, self.reg_max)
-            target_ltrb_pos = torch.masked_select(target_ltrb, bbox_mask).view(-1, 4)
-            loss_dfl = self._df_loss(pred_dist_pos, target_ltrb_pos) * bbox_weight
-            loss_dfl = loss_dfl.sum() / target_scores_sum
+            pred_dist_pos = pred_dist[b, a].view(-1, 4, self.reg_max + 1)
+            target_ltrb_pos = bbox2dist(anchor_points[a], target_bboxes_pos, self.reg_max)
+            loss_dfl = (self._df_loss(pred_dist_pos, target_ltrb_pos) * bbox_weight).sum() / target_scores_sum
         else:
             loss_dfl = torch.tensor(0.0).to(pred_dist.device)
 
         return loss_iou, loss_dfl, iou
 
     def _df_loss(self, pred_dist, target):
+        # left and right bin terms from a single log-softmax, (n, 4, reg_max + 1) -> (n, 1)
         target_left = target.to(torch.long)
-        target_right = target_left + 1
-        weight_left = target_right.to(torch.float) - target
+        weight_left = (target_left + 1).to(torch.float) - target
         weight_right = 1 - weight_left
-        loss_left = F.cross_entropy(pred_dist.view(-1, self.reg_max + 1), target_left.view(-1), reduction="none").view(
-            target_left.shape) * weight_left
-        loss_right = F.cross_entropy(pred_dist.view(-1, self.reg_max + 1), target_right.view(-1),
-                                     reduction="none").view(target_left.shape) * weight_right
-        return (loss_left + loss_right).mean(-1, keepdim=True)
+        logp = pred_dist.log_softmax(-1).gather(-1, torch.stack((target_left, target_left + 1), -1))
+        return -(logp[..., 0] * weight_left + logp[..., 1] * weight_right).mean(-1, keepdim=True)
 
 
 class ComputeLoss:
@@ -134,25 +125,15 @@ class ComputeLoss:
         self.assigner = TaskAlignedAssigner(topk=int(os.getenv('YOLOM', 10)),
                                             num_classes=self.nc,
                                             alpha=float(os.getenv('YOLOA', 0.5)),
-                                            beta=float(os.getenv('YOLOB', 6.0)))
+                                            beta=float(os.getenv('YOLOB', 6.0)),
+                                            max_mb=int(os.getenv('TAL_MAX_MB', 0)),
+                                            sparse=str(os.getenv('TAL_SPARSE', False)).lower() == 'true')
         self.bbox_loss = BboxLoss(m.reg_max - 1, use_dfl=use_dfl).to(device)
         self.proj = torch.arange(m.reg_max).float().to(device)  # / 120.0
         self.use_dfl = use_dfl
 
     def preprocess(self, targets, batch_size, scale_tensor):
-        if targets.shape[0] == 0:
-            out = torch.zeros(batch_size, 0, 5, device=self.device)
-        else:
-            i = targets[:, 0]  # image index
-            _, counts = i.unique(return_counts=True)
-            out = torch.zeros(batch_size, counts.max(), 5, device=self.device)
-            for j in range(batch_size):
-                matches = i == j
-                n = matches.sum()
-                if n:
-                    out[j, :n] = targets[matches, 1:]
-            out[..., 1:5] = xywh2xyxy(out[..., 1:5].mul_(scale_tensor))
-        return out
+        return pack_targets(targets.to(self.device), batch_size, scale_tensor)
 
     def bbox_decode(self, anchor_points, pred_dist):
         if self.use_dfl:
@@ -174,6 +155,7 @@ class ComputeLoss:
         batch_size, grid_size = pred_scores.shape[:2]
         imgsz = torch.tensor(feats[0].shape[2:], device=self.device, dtype=dtype) * self.stride[0]  # image size (h,w)
         anchor_points, stride_tensor = make_anchors(feats, self.stride, 0.5)
+        levels = anchor_levels(feats, self.stride)
 
         # targets
         targets = self.preprocess(targets, batch_size, scale_tensor=imgsz[[1, 0, 1, 0]])
@@ -189,7 +171,8 @@ class ComputeLoss:
             anchor_points * stride_tensor,
             gt_labels,
             gt_bboxes,
-            mask_gt)
+            mask_gt,
+            levels)
 
         target_bboxes /= stride_tensor
         target_scores_sum = max(target_scores.sum(), 1)
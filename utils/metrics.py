@@ -5,9 +5,11 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
 
 from utils import TryExcept, threaded
 
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz  # np.trapz was removed in numpy 2.4
 
 def fitness(x):
     # Model fitness as a weighted combination of metrics
@@ -23,7 +25,7 @@ def smooth(y, f=0.05):
     return np.convolve(yp, np.ones(nf) / nf, mode='valid')  # y-smoothed
 
 
-def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16, prefix=""):
+def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names=(), eps=1e-16, prefix="", n=None):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
     # Arguments
@@ -33,6 +35,7 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
         target_cls:  True object classes (nparray).
         plot:  Plot precision-recall curve at mAP@0.5
         save_dir:  Plot save directory
+        n:  Predictions per row (nparray), tp then counts true positives, i.e. binned APAccumulator rows
     # Returns
         The average precision as computed in py-faster-rcnn.
     """
@@ -40,38 +43,50 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     # Sort by objectness
     i = np.argsort(-conf)
     tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    n = np.ones((len(tp), 1)) if n is None else n[i, None]
 
     # Find unique classes
     unique_classes, nt = np.unique(target_cls, return_counts=True)
     nc = unique_classes.shape[0]  # number of classes, number of detections
 
-    # Create Precision-Recall curve and compute AP for each class
+    # Group predictions by class (stable, so still by objectness within a class), drop classes without labels
+    ci = np.searchsorted(unique_classes, pred_cls).clip(max=max(nc - 1, 0))
+    i = np.flatnonzero(unique_classes[ci] == pred_cls) if nc else np.zeros(0, dtype=int)
+    i = i[np.argsort(ci[i], kind='stable')]
+    tp, conf, n, ci = tp[i], conf[i], n[i], ci[i]
+    bounds = np.searchsorted(ci, np.arange(nc + 1))  # predictions of class k are bounds[k]:bounds[k + 1]
+    has = np.diff(bounds) > 0  # classes with predictions
+    b = np.append(bounds[:-1][has], len(ci))  # bounds of those classes
+    g = np.cumsum(has) - 1  # group of each class with predictions
+
+    # Accumulate FPs and TPs within classes
+    tpc, fpc = tp.cumsum(0), (n - tp).cumsum(0)
+    tpc = tpc - np.concatenate((np.zeros((1, tp.shape[1])), tpc))[bounds[ci]]
+    fpc = fpc - np.concatenate((np.zeros((1, tp.shape[1])), fpc))[bounds[ci]]
+    recall = tpc / (nt[ci, None] + eps)  # recall curve
+    precision = tpc / (tpc + fpc)  # precision curve
+
+    # Precision and recall at pr_score, negative x, xp because xp decreases
     px, py = np.linspace(0, 1, 1000), []  # for plotting
     ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
-    for ci, c in enumerate(unique_classes):
-        i = pred_cls == c
-        n_l = nt[ci]  # number of labels
-        n_p = i.sum()  # number of predictions
-        if n_p == 0 or n_l == 0:
-            continue
-
-        # Accumulate FPs and TPs
-        fpc = (1 - tp[i]).cumsum(0)
-        tpc = tp[i].cumsum(0)
-
-        # Recall
-        recall = tpc / (n_l + eps)  # recall curve
-        r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
-
-        # Precision
-        precision = tpc / (tpc + fpc)  # precision curve
-        p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
-
-        # AP from recall-precision curve
-        for j in range(tp.shape[1]):
-            ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
-            if plot and j == 0:
-                py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+    r[has] = interp_groups(-px, -conf, recall[:, 0], b, left=0)
+    p[has] = interp_groups(-px, -conf, precision[:, 0], b, left=1)
+
+    # AP from recall-precision curves of every class and IoU threshold, see compute_ap()
+    k, t = len(b) - 1, tp.shape[1]
+    head, tail = b[:-1] + 2 * np.arange(k), b[1:] + 2 * np.arange(k) + 1  # sentinel positions
+    rows = np.arange(len(ci)) + 2 * g[ci] + 1
+    mrec, mpre = np.zeros((len(ci) + 2 * k, t)), np.zeros((len(ci) + 2 * k, t))
+    mrec[rows], mrec[tail] = recall, 1.0
+    mpre[rows], mpre[head] = precision, 1.0
+    off = 2.0 * np.repeat(np.arange(k), tail - head + 1)[:, None]  # keeps the envelope of each class to itself
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre - off, 0), 0), 0) + off  # precision envelope
+    x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
+    seg = (np.append(head, len(mrec)) + len(mrec) * np.arange(t)[:, None])[:, :-1].ravel()
+    y = interp_groups(x, mrec.T.ravel(), mpre.T.ravel(), np.append(seg, mrec.size))  # (t * k, 101)
+    ap[has] = trapezoid(y, x).reshape(t, k).T  # integrate
+    if plot and k:
+        py = list(interp_groups(px, mrec[:, 0], mpre[:, 0], np.append(head, len(mrec))))  # precision at mAP@0.5
 
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + eps)
@@ -90,6 +105,30 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
     return tp, fp, p, r, f1, ap, unique_classes.astype(int)
 
 
+def interp_groups(x, xp, fp, bounds, left=None):
+    """ np.interp(x, xp[s:e], fp[s:e], left=left) for all groups s, e = bounds[k], bounds[k + 1] at once.
+    # Arguments
+        x:  The x-coordinates to evaluate, shared by the groups (nparray).
+        xp:  The data x-coordinates, increasing within each group (nparray).
+        fp:  The data y-coordinates (nparray).
+        bounds:  Group boundaries, non-empty groups (nparray).
+    # Returns
+        Interpolated values (nparray, groups x len(x))
+    """
+    x, xp, fp = (np.asarray(a, dtype=np.float64) for a in (x, xp, fp))  # as np.interp
+    s, e = bounds[:-1, None], bounds[1:, None] - 1  # first, last index of each group
+    lo = min(xp.min(), x.min()) if len(xp) else 0.0
+    step = max(xp.max(), x.max()) - lo + 1 if len(xp) else 1.0  # key spacing, so groups never overlap
+    key = xp - lo + np.repeat(np.arange(len(s)), np.diff(bounds)) * step
+    j = np.searchsorted(key, x - lo + np.arange(len(s))[:, None] * step, side='right') - 1  # last xp <= x
+    j0 = j.clip(s, e)
+    j1 = (j0 + 1).clip(max=e)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (fp[j1] - fp[j0]) / (xp[j1] - xp[j0])
+        y = np.where((j1 > j0) & (xp[j0] != x), slope * (x - xp[j0]) + fp[j0], fp[j0])
+    return y if left is None else np.where(j < s, left, y)
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
@@ -110,7 +149,7 @@ def compute_ap(recall, precision):
     method = 'interp'  # methods: 'continuous', 'interp'
     if method == 'interp':
         x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
-        ap = np.trapz(np.interp(x, mrec, mpre), x)  # integrate
+        ap = trapezoid(np.interp(x, mrec, mpre), x)  # integrate
     else:  # 'continuous'
         i = np.where(mrec[1:] != mrec[:-1])[0]  # points where x axis (recall) changes
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])  # area under curve
@@ -118,62 +157,165 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+def match_predictions(iou, correct_class, iouv):
+    """ Greedy matching of val.py process_batch() for all IoU thresholds at once, on device.
+    Each detection takes its highest-IoU label of the right class, then each label keeps the first detection (highest
+    confidence, in NMS order) that took it.
+    # Arguments
+        iou:  IoU of labels and detections (tensor[M, N]).
+        correct_class:  Label and detection classes match (tensor[M, N]), False between the images of a packed batch.
+        iouv:  IoU thresholds (tensor[T]).
+    # Returns
+        correct (tensor[N, T]), bool
+    """
+    (m, n), t = iou.shape, iouv.shape[0]
+    if not (m and n):
+        return torch.zeros((n, t), dtype=torch.bool, device=iouv.device)
+    valid = (iou[None] >= iouv[:, None, None]) & correct_class  # (T, M, N)
+    matched = valid.any(1)  # (T, N)
+    label = torch.where(valid, iou[None], -1.0).argmax(1) + torch.arange(t, device=iou.device)[:, None] * m  # (T, N)
+    det = torch.arange(n, device=iou.device).expand(t, n)
+    first = torch.full((t * m,), n, device=iou.device).scatter_reduce_(0, label[matched], det[matched], 'amin')
+    return (matched & (first[label] == det)).T
+
+
+class APAccumulator:
+    # (correct, conf, pcls, tcls) statistics for ap_per_class(), gathered on device image by image
+    def __init__(self, nc, niou=10, bins=0, device=None):
+        """bins=0 keeps every prediction for exact ap_per_class() results. bins > 0 keeps per-class histograms of true
+        positives over that many confidence bins instead, constant in size for any number of images"""
+        self.nc = nc  # number of classes
+        self.niou = niou  # number of IoU thresholds
+        self.bins = bins
+        self.nt = torch.zeros(nc, dtype=torch.long, device=device)  # targets per class
+        if bins:
+            self.n = torch.zeros(nc * bins, dtype=torch.long, device=device)  # predictions per class and bin
+            self.tp = torch.zeros(nc * bins * niou, dtype=torch.long, device=device)  # true positives per IoU
+        else:
+            self.stats = []  # (correct, conf, pcls) per image
+
+    def update(self, correct, conf, pcls, tcls):
+        """correct(n, niou) bool, conf(n), pcls(n) of the predictions and tcls(m) of the labels of an image"""
+        tcls = tcls.long()
+        self.nt.scatter_add_(0, tcls, torch.ones_like(tcls))
+        if not self.bins:
+            self.stats.append((correct, conf, pcls))
+            return
+        k = pcls < self.nc  # ap_per_class() ignores classes without labels
+        i = pcls[k].long() * self.bins + (conf[k] * self.bins).long().clamp_(0, self.bins - 1)
+        self.n.scatter_add_(0, i, torch.ones_like(i))
+        j, iou = correct[k].nonzero(as_tuple=True)
+        j = i[j] * self.niou + iou
+        self.tp.scatter_add_(0, j, torch.ones_like(j))
+
+    def merge(self, other):
+        # Add the statistics of another accumulator with the same settings, i.e. from another DDP rank
+        self.nt += other.nt.to(self.nt.device)
+        if self.bins:
+            self.n += other.n.to(self.n.device)
+            self.tp += other.tp.to(self.tp.device)
+        else:
+            self.stats += [tuple(x.to(self.nt.device) for x in s) for s in other.stats]
+        return self
+
+    def reduce(self):
+        # Merge the accumulators of all DDP ranks into each rank
+        if not (dist.is_available() and dist.is_initialized()):
+            return self
+        if self.bins:
+            for x in self.nt, self.n, self.tp:
+                dist.all_reduce(x)
+        else:
+            ranks = [None] * dist.get_world_size()
+            dist.all_gather_object(ranks, (self.nt.cpu(), [tuple(x.cpu() for x in s) for s in self.stats]))
+            self.nt.zero_()
+            self.stats = []
+            for nt, stats in ranks:
+                self.nt += nt.to(self.nt.device)
+                self.stats += [tuple(x.to(self.nt.device) for x in s) for s in stats]
+        return self
+
+    def result(self):
+        # tp, conf, pred_cls, target_cls and n numpy arrays for ap_per_class(tp, conf, pred_cls, target_cls, n=n)
+        nt = self.nt.cpu().numpy()
+        target_cls = np.repeat(np.arange(self.nc), nt)
+        if self.bins:
+            i = self.n.nonzero()[:, 0]  # bins with predictions
+            tp = self.tp.view(-1, self.niou)[i]
+            conf = ((i % self.bins) + 0.5) / self.bins  # bin centres
+            return (tp.cpu().numpy(), conf.cpu().numpy(), (i // self.bins).cpu().numpy(), target_cls,
+                    self.n[i].cpu().numpy())
+        if not self.stats:
+            return np.zeros((0, self.niou), dtype=bool), np.zeros(0), np.zeros(0), target_cls, None
+        tp, conf, pred_cls = (torch.cat(x, 0).cpu().numpy() for x in zip(*self.stats))
+        return tp, conf, pred_cls, target_cls, None
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
-        self.matrix = np.zeros((nc + 1, nc + 1))
+        self.counts = torch.zeros((nc + 1) ** 2, dtype=torch.long)  # flat (nc + 1, nc + 1), on the device of updates
         self.nc = nc  # number of classes
         self.conf = conf
         self.iou_thres = iou_thres
 
-    def process_batch(self, detections, labels):
+    @property
+    def matrix(self):
+        return self.counts.view(self.nc + 1, self.nc + 1).cpu().numpy().astype(float)
+
+    def process_batch(self, detections, labels, di=None, li=None):
         """
         Return intersection-over-union (Jaccard index) of boxes.
         Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
         Arguments:
             detections (Array[N, 6]), x1, y1, x2, y2, conf, class
             labels (Array[M, 5]), class, x1, y1, x2, y2
+            di, li (Array[N], Array[M]), image index of detections and labels, to update with a packed batch at once
         Returns:
             None, updates confusion matrix accordingly
         """
+        nc = self.nc
         if detections is None:
-            gt_classes = labels.int()
-            for gc in gt_classes:
-                self.matrix[self.nc, gc] += 1  # background FN
+            self.update(nc * (nc + 1) + labels.long())  # background FN
             return
 
-        detections = detections[detections[:, 4] > self.conf]
-        gt_classes = labels[:, 0].int()
-        detection_classes = detections[:, 5].int()
-        iou = box_iou(labels[:, 1:], detections[:, :4])
-
-        x = torch.where(iou > self.iou_thres)
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+        k = detections[:, 4] > self.conf
+        detections = detections[k]
+        gt_classes = labels[:, 0].long()
+        detection_classes = detections[:, 5].long()
+        m, n = len(labels), len(detections)
+        if not m:  # no labels, nothing matched and no background FP
+            return
+        if di is None:
+            di, li = labels.new_zeros(n), labels.new_zeros(m)
         else:
-            matches = np.zeros((0, 3))
-
-        n = matches.shape[0] > 0
-        m0, m1, _ = matches.transpose().astype(int)
-        for i, gc in enumerate(gt_classes):
-            j = m0 == i
-            if n and sum(j) == 1:
-                self.matrix[detection_classes[m1[j]], gc] += 1  # correct
-            else:
-                self.matrix[self.nc, gc] += 1  # true background
+            di = di[k]
 
+        # Each detection takes its highest-IoU label, each label keeps the highest-IoU detection that took it
+        iou = box_iou(labels[:, 1:], detections[:, :4])
+        iou = torch.where((iou > self.iou_thres) & (li[:, None] == di), iou, 0.0)  # (M, N), block-diagonal by image
+        j = torch.arange(n, device=iou.device)
+        best, label = iou.max(0)
+        matched = best > 0
+        top = iou.new_zeros(m).scatter_reduce_(0, label[matched], best[matched], 'amax')
+        matched &= best == top[label]
+        det = j.new_full((m,), n).scatter_reduce_(0, label[matched], j[matched], 'amin')  # detection of each label
+        gt_matched = det < n
+
+        # Matched labels count as correct or confused and unmatched ones as background FN. Unmatched detections count as
+        # background FP only in images that have a match, as in the per-image update
+        dc = torch.full_like(gt_classes, nc)  # predicted class of each label
         if n:
-            for i, dc in enumerate(detection_classes):
-                if not any(m1 == i):
-                    self.matrix[dc, self.nc] += 1  # predicted background
-
-    def matrix(self):
-        return self.matrix
+            dc = torch.where(gt_matched, detection_classes[det.clamp(max=n - 1)], nc)
+        fp = ((li[:, None] == di) & gt_matched[:, None]).any(0)  # detections in images with a match
+        fp[det[gt_matched]] = False
+        self.update(torch.cat((dc * (nc + 1) + gt_classes, detection_classes[fp] * (nc + 1) + nc)))
+
+    def update(self, i):
+        # Add one count for each flat (predicted, true) index of i
+        if self.counts.device != i.device:
+            self.counts = self.counts.to(i.device)
+        self.counts += torch.bincount(i, minlength=len(self.counts))
 
     def tp_fp(self):
         tp = self.matrix.diagonal()  # true positives
@@ -4,8 +4,7 @@ import random
 import pickle
 from pathlib import Path
 
-from itertools import repeat
-from multiprocessing.pool import Pool, ThreadPool
+from multiprocessing.pool import ThreadPool
 
 import cv2
 import numpy as np
@@ -13,9 +12,9 @@ import torch
 from torch.utils.data import DataLoader, distributed
 from tqdm import tqdm
 
-from ..augmentations import augment_hsv
-from ..dataloaders import InfiniteDataLoader, LoadImagesAndLabels, seed_worker, get_hash, verify_image_label, HELP_URL, TQDM_BAR_FORMAT, LOCAL_RANK
-from ..general import NUM_THREADS, LOGGER, xyn2xy, xywhn2xyxy, xyxy2xywhn
+from ..augmentations import augment_batch, augment_hsv, flip_batch
+from ..dataloaders import InfiniteDataLoader, LoadImagesAndLabels, seed_worker, HELP_URL, TQDM_BAR_FORMAT, LOCAL_RANK, unpack_labels, unpack_mask
+from ..general import LOGGER, xyn2xy, xywhn2xyxy, xyxy2xywhn
 from ..torch_utils import torch_distributed_zero_first
 from ..coco_utils import annToMask, getCocoIds
 from .augmentations import mixup, random_perspective, copy_paste, letterbox
@@ -41,7 +40,9 @@ def create_dataloader(path,
                       prefix='',
                       shuffle=False,
                       mask_downsample_ratio=1,
-                      overlap_mask=False):
+                      overlap_mask=False,
+                      batch_augment=False,
+                      cache_masks=False):
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -60,7 +61,9 @@ def create_dataloader(path,
             image_weights=image_weights,
             prefix=prefix,
             downsample_ratio=mask_downsample_ratio,
-            overlap=overlap_mask)
+            overlap=overlap_mask,
+            cache_masks=cache_masks)
+    dataset.batch_augment = batch_augment and augment  # HSV and flips left to the training loop, see augment_batch()
 
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
@@ -107,6 +110,7 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
         prefix="",
         downsample_ratio=1,
         overlap=False,
+        cache_masks=False,
     ):
         super().__init__(
             path,
@@ -133,26 +137,21 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
         p = Path(path)
         cache_path = (p.with_suffix('') if p.is_file() else Path(self.seg_files[0]).parent)
         cache_path = Path(str(cache_path) + '_stuff').with_suffix('.cache')
-        try:
-            cache, exists = np.load(cache_path, allow_pickle = True).item(), True  # load dict
-            #assert cache['version'] == self.cache_version  # matches current version
-            #assert cache['hash'] == get_hash(self.seg_files + self.im_files)  # identical hash
-        except Exception:
-            cache, exists = self.cache_seg_labels(cache_path, prefix), False  # run cache ops
+        cache, arrays, exists = self.check_cache_labels(cache_path, self.seg_files, prefix)
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
+        nf, nm, ne, nc, n = cache['results']  # found, missing, empty, corrupt, total
         if exists and LOCAL_RANK in {-1, 0}:
             d = f"Scanning '{cache_path}' images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupt"
             tqdm(None, desc = (prefix + d), total = n, initial = n, bar_format = TQDM_BAR_FORMAT)  # display cache results
-            if cache['msgs']:
-                LOGGER.info('\n'.join(cache['msgs']))  # display warnings
+            msgs = [x for x in cache['msgs'] if x]
+            if msgs:
+                LOGGER.info('\n'.join(msgs))  # display warnings
         assert (0 < nf) or (not augment), f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
-        seg_labels, _, self.semantic_masks = zip(*cache.values())
-        nl = len(np.concatenate(seg_labels, 0))  # number of labels
+        seg_labels, _, self.semantic_masks = unpack_labels(arrays)
+        nl = len(arrays['labels'])  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
 
         # Update labels
@@ -169,6 +168,10 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
                 if semantic_masks:
                     self.semantic_masks[i][:, 0] = 0
 
+        self.mask_cache = None  # run-length encoded masks, only without augmentation
+        if cache_masks and not augment:
+            self.mask_cache = self.cache_masks([self.segments, self.semantic_masks], prefix)
+
     def __getitem__(self, index):
         index = self.indices[index]  # linear, shuffled, or image_weights
 
@@ -238,21 +241,12 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
         nl = len(labels)  # number of labels
         if nl:
             labels[:, 1:5] = xyxy2xywhn(labels[:, 1:5], w=img.shape[1], h=img.shape[0], clip=True, eps=1e-3)
-            if self.overlap:
-                masks, sorted_idx = polygons2masks_overlap(img.shape[:2],
-                                                           segments,
-                                                           downsample_ratio=self.downsample_ratio)
-                masks = masks[None]  # (640, 640) -> (1, 640, 640)
-                labels = labels[sorted_idx]
-            else:
-                masks = polygons2masks(img.shape[:2], segments, color=1, downsample_ratio=self.downsample_ratio)
-
-        masks = (torch.from_numpy(masks) if len(masks) else torch.zeros(1 if self.overlap else nl, img.shape[0] //
-                                                                        self.downsample_ratio, img.shape[1] //
-                                                                        self.downsample_ratio))
-        semantic_masks = polygons2masks(img.shape[:2], semantic_masks, color = 1, downsample_ratio=self.downsample_ratio)
-        #semantic_masks = polygons2masks(img.shape[:2], semantic_masks, color = 1, downsample_ratio=1)
-        semantic_masks = torch.from_numpy(semantic_masks)
+        if self.mask_cache is not None:  # rasterized once
+            masks, order, semantic_seg_masks = (unpack_mask(self.mask_cache, index * 3 + j) for j in range(3))
+            masks, labels, semantic_seg_masks = torch.from_numpy(masks), labels[order], torch.from_numpy(semantic_seg_masks)
+        else:
+            masks, labels = self.polygon_masks(img.shape[:2], labels, segments)
+            semantic_seg_masks = self.semantic_seg_masks(img.shape[:2], seg_cls, semantic_masks)
         # TODO: albumentations support
         if self.augment:
             # Albumentations
@@ -260,8 +254,8 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
             # so just be it for now.
             img, labels = self.albumentations(img, labels)
             nl = len(labels)  # update after albumentations
-            ns = len(semantic_masks)
 
+        if self.augment and not self.batch_augment:
             # HSV color-space
             augment_hsv(img, hgain=hyp["hsv_h"], sgain=hyp["hsv_s"], vgain=hyp["hsv_v"])
 
@@ -271,8 +265,7 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
                 if nl:
                     labels[:, 2] = 1 - labels[:, 2]
                     masks = torch.flip(masks, dims=[1])
-                if ns:
-                    semantic_masks = torch.flip(semantic_masks, dims = [1])
+                semantic_seg_masks = torch.flip(semantic_seg_masks, dims=[0])
 
             # Flip left-right
             if random.random() < hyp["fliplr"]:
@@ -280,8 +273,7 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
                 if nl:
                     labels[:, 1] = 1 - labels[:, 1]
                     masks = torch.flip(masks, dims=[2])
-                if ns:
-                    semantic_masks = torch.flip(semantic_masks, dims = [2])
+                semantic_seg_masks = torch.flip(semantic_seg_masks, dims=[1])
 
             # Cutouts  # labels = cutout(img, labels, p=0.5)
 
@@ -289,20 +281,55 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
         if nl:
             labels_out[:, 1:] = torch.from_numpy(labels)
 
-        # Combine semantic masks
-        semantic_seg_masks = torch.zeros((len(self.coco_ids), img.shape[0] // self.downsample_ratio, 
-                                          img.shape[1] // self.downsample_ratio), dtype = torch.uint8)
-        #semantic_seg_masks = torch.zeros((len(self.coco_ids), img.shape[0], img.shape[1]), dtype = torch.uint8)
-        for cls_id, semantic_mask in zip(seg_cls, semantic_masks):
-            semantic_seg_masks[cls_id] = (semantic_seg_masks[cls_id].logical_or(semantic_mask)).int()
-
-
         # Convert
         img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
         img = np.ascontiguousarray(img)
 
         return (torch.from_numpy(img), labels_out, self.im_files[index], shapes, masks, semantic_seg_masks)
 
+    def augment_batch(self, im, targets, masks, semantic_masks):
+        # HSV and flip augmentation of a collated uint8 batch in place, flipping masks to match
+        ud, lr = augment_batch(im, targets, self.hyp)
+        i = slice(None) if self.overlap else targets[:, 0].long()  # mask image index, one mask per image if overlap
+        flip_batch(masks, ud[i], lr[i])
+        flip_batch(semantic_masks, ud, lr)
+
+    def polygon_masks(self, shape, labels, segments):
+        # Rasterize segments into masks at downsample_ratio for an image of shape(h,w), labels are reordered if overlap
+        masks, nl = [], len(labels)
+        if nl:
+            if self.overlap:
+                masks, sorted_idx = polygons2masks_overlap(shape, segments, downsample_ratio=self.downsample_ratio)
+                masks = masks[None]  # (640, 640) -> (1, 640, 640)
+                labels = labels[sorted_idx]
+            else:
+                masks = polygons2masks(shape, segments, color=1, downsample_ratio=self.downsample_ratio)
+
+        masks = (torch.from_numpy(masks) if len(masks) else torch.zeros(1 if self.overlap else nl, shape[0] //
+                                                                        self.downsample_ratio, shape[1] //
+                                                                        self.downsample_ratio, dtype=torch.uint8))
+        return masks, labels
+
+    def semantic_seg_masks(self, shape, seg_cls, semantic_masks):
+        # Rasterize semantic polygons at downsample_ratio into one int16 class-id map(h,w), -1 where unlabelled.
+        # Where polygons overlap the last one wins, one-hot expansion is left to semantic_onehot() per batch
+        if not len(semantic_masks):
+            h, w = shape[0] // self.downsample_ratio, shape[1] // self.downsample_ratio
+            return torch.full((h, w), -1, dtype=torch.int16)
+        semantic_masks = polygons2masks(shape, semantic_masks, color=1, downsample_ratio=self.downsample_ratio)
+        n = len(semantic_masks)
+        last = (semantic_masks * np.arange(1, n + 1, dtype=np.int16).reshape(-1, 1, 1)).max(0)  # last polygon + 1
+        return torch.from_numpy(np.array([-1, *seg_cls], dtype=np.int16)[last])  # polygon to class id
+
+    def rasterize(self, i):
+        # Returns the (masks, label order, semantic masks) of image i as __getitem__() rasterizes them without augmentation
+        shape, ratio, pad = self.letterbox_shape(i)
+        h, w = self.im_hw[i]
+        segments = [xyn2xy(x, ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1]) for x in self.segments[i]]
+        semantic_masks = [xyn2xy(x, ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1]) for x in self.semantic_masks[i]]
+        masks, order = self.polygon_masks(shape, np.arange(len(self.labels[i])), segments)
+        return masks.numpy(), order, self.semantic_seg_masks(shape, self.seg_cls[i], semantic_masks).numpy()
+
     def load_mosaic(self, index):
         # YOLO 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
         labels4, segments4, seg_cls, semantic_masks4 = [], [], [], []
@@ -370,44 +397,6 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
 
         return img4, labels4, segments4, seg_cls, semantic_masks4
 
-    def cache_seg_labels(self, path = Path('./labels_stuff.cache'), prefix = ''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
-        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
-        with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.seg_files, repeat(prefix))),
-                        desc = desc,
-                        total = len(self.im_files),
-                        bar_format = TQDM_BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
-                if im_file:
-                    x[im_file] = [lb, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc}{nf} found, {nm} missing, {ne} empty, {nc} corrupt"
-
-        pbar.close()
-        if msgs:
-            LOGGER.info('\n'.join(msgs))
-        if nf == 0:
-            LOGGER.warning(f'{prefix}WARNING: No labels found in {path}. {HELP_URL}')
-        x['hash'] = get_hash(self.seg_files + self.im_files)
-        x['results'] = nf, nm, ne, nc, len(self.im_files)
-        x['msgs'] = msgs  # warnings
-        x['version'] = self.cache_version  # cache version
-        try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
-            LOGGER.info(f'{prefix}New cache created: {path}')
-        except Exception as e:
-            LOGGER.warning(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # not writeable
-        return x
-
     @staticmethod
     def collate_fn(batch):
         img, label, path, shapes, masks, semantic_masks = zip(*batch)  # transposed
@@ -135,3 +135,20 @@ def masks2segments(masks, strategy='largest'):
             c = np.zeros((0, 2))  # no segments found
         segments.append(c.astype('float32'))
     return segments
+
+
+def semantic_onehot(semasks, nc, dtype=torch.float32):
+    """
+    Expand batched semantic class-id maps into one-hot masks.
+
+    Args:
+        - semasks should be a size [b, h, w] tensor of class ids, -1 where no class is labelled
+        - nc is the number of semantic classes
+
+    return: b, nc, h, w
+    """
+
+    b, h, w = semasks.shape
+    onehot = torch.zeros((b, nc, h, w), device=semasks.device, dtype=dtype)
+    semasks = semasks.long().unsqueeze(1)
+    return onehot.scatter_(1, semasks.clamp(min=0), (semasks >= 0).to(dtype))
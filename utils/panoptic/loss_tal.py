@@ -6,12 +6,13 @@ import torch.nn.functional as F
 
 from torchvision.ops import sigmoid_focal_loss
 
-from utils.general import xywh2xyxy, xyxy2xywh
-from utils.metrics import bbox_iou
-from utils.panoptic.tal.anchor_generator import dist2bbox, make_anchors, bbox2dist
+from utils.general import pack_targets
+from utils.loss_tal import BboxLoss
+from utils.segment.loss_tal import mask_loss, proto_masks
+from utils.panoptic.tal.anchor_generator import dist2bbox, make_anchors
 from utils.panoptic.tal.assigner import TaskAlignedAssigner
 from utils.torch_utils import de_parallel
-from utils.panoptic.general import crop_mask
+from utils.panoptic.general import semantic_onehot
 
 
 def smooth_BCE(eps=0.1):  # https://github.com/ultralytics/yolov3/issues/238#issuecomment-598028441
@@ -62,63 +63,6 @@ class FocalLoss(nn.Module):
             return loss
 
 
-class BboxLoss(nn.Module):
-    def __init__(self, reg_max, use_dfl=False):
-        super().__init__()
-        self.reg_max = reg_max
-        self.use_dfl = use_dfl
-
-    def forward(self, pred_dist, pred_bboxes, anchor_points, target_bboxes, target_scores, target_scores_sum, fg_mask):
-        # iou loss
-        bbox_mask = fg_mask.unsqueeze(-1).repeat([1, 1, 4])  # (b, h*w, 4)
-        pred_bboxes_pos = torch.masked_select(pred_bboxes, bbox_mask).view(-1, 4)
-        target_bboxes_pos = torch.masked_select(target_bboxes, bbox_mask).view(-1, 4)
-        bbox_weight = torch.masked_select(target_scores.sum(-1), fg_mask).unsqueeze(-1)
-        
-        iou = bbox_iou(pred_bboxes_pos, target_bboxes_pos, xywh=False, CIoU=True)
-        loss_iou = 1.0 - iou
-                
-        #### wiou
-        #iou = bbox_iou(pred_bboxes_pos, target_bboxes_pos, xywh=False, WIoU=True, scale=True)
-        #if type(iou) is tuple:
-        #    if len(iou) == 2:
-        #        loss_iou = (iou[1].detach() * (1 - iou[0]))
-        #        iou = iou[0]
-        #    else:
-        #        loss_iou = (iou[0] * iou[1])
-        #        iou = iou[-1]
-        #else:
-        #    loss_iou = (1.0 - iou)  # iou loss
-
-        loss_iou *= bbox_weight
-        loss_iou = loss_iou.sum() / target_scores_sum
-        # loss_iou = loss_iou.mean()
-
-        # dfl loss
-        if self.use_dfl:
-            dist_mask = fg_mask.unsqueeze(-1).repeat([1, 1, (self.reg_max + 1) * 4])
-            pred_dist_pos = torch.masked_select(pred_dist, dist_mask).view(-1, 4, self.reg_max + 1)
-            target_ltrb = bbox2dist(anchor_points, target_bboxes, self.reg_max)
-            target_ltrb_pos = torch.masked_select(target_ltrb, bbox_mask).view(-1, 4)
-            loss_dfl = self._df_loss(pred_dist_pos, target_ltrb_pos) * bbox_weight
-            loss_dfl = loss_dfl.sum() / target_scores_sum
-        else:
-            loss_dfl = torch.tensor(0.0).to(pred_dist.device)
-
-        return loss_iou, loss_dfl, iou
-
-    def _df_loss(self, pred_dist, target):
-        target_left = target.to(torch.long)
-        target_right = target_left + 1
-        weight_left = target_right.to(torch.float) - target
-        weight_right = 1 - weight_left
-        loss_left = F.cross_entropy(pred_dist.view(-1, self.reg_max + 1), target_left.view(-1), reduction="none").view(
-            target_left.shape) * weight_left
-        loss_right = F.cross_entropy(pred_dist.view(-1, self.reg_max + 1), target_right.view(-1),
-                                     reduction="none").view(target_left.shape) * weight_right
-        return (loss_left + loss_right).mean(-1, keepdim=True)
-
-
 class ComputeLoss:
     # Compute losses
     def __init__(self, model, use_dfl=True, overlap=True):
@@ -152,25 +96,14 @@ class ComputeLoss:
         self.assigner = TaskAlignedAssigner(topk=int(os.getenv('YOLOM', 10)),
                                             num_classes=self.nc,
                                             alpha=float(os.getenv('YOLOA', 0.5)),
-                                            beta=float(os.getenv('YOLOB', 6.0)))
+                                            beta=float(os.getenv('YOLOB', 6.0)),
+                                            max_mb=int(os.getenv('TAL_MAX_MB', 0)))
         self.bbox_loss = BboxLoss(m.reg_max - 1, use_dfl=use_dfl).to(device)
         self.proj = torch.arange(m.reg_max).float().to(device)  # / 120.0
         self.use_dfl = use_dfl
 
     def preprocess(self, targets, batch_size, scale_tensor):
-        if targets.shape[0] == 0:
-            out = torch.zeros(batch_size, 0, 5, device=self.device)
-        else:
-            i = targets[:, 0]  # image index
-            _, counts = i.unique(return_counts=True)
-            out = torch.zeros(batch_size, counts.max(), 5, device=self.device)
-            for j in range(batch_size):
-                matches = i == j
-                n = matches.sum()
-                if n:
-                    out[j, :n] = targets[matches, 1:]
-            out[..., 1:5] = xywh2xyxy(out[..., 1:5].mul_(scale_tensor))
-        return out
+        return pack_targets(targets.to(self.device), batch_size, scale_tensor)
 
     def bbox_decode(self, anchor_points, pred_dist):
         if self.use_dfl:
@@ -233,22 +166,14 @@ class ComputeLoss:
                                                   fg_mask)
             
             # masks loss
-            if tuple(masks.shape[-2:]) != (mask_h, mask_w):  # downsample
-                masks = F.interpolate(masks[None], (mask_h, mask_w), mode='nearest')[0]
+            masks = proto_masks(masks, (mask_h, mask_w))
                 
-            for i in range(batch_size):
-                if fg_mask[i].sum():
-                    mask_idx = target_gt_idx[i][fg_mask[i]]
-                    if self.overlap:
-                        gt_mask = torch.where(masks[[i]] == (mask_idx + 1).view(-1, 1, 1), 1.0, 0.0)
-                    else:
-                        gt_mask = masks[batch_idx.view(-1) == i][mask_idx]
-                    xyxyn = target_bboxes[i][fg_mask[i]] / imgsz[[1, 0, 1, 0]]
-                    marea = xyxy2xywh(xyxyn)[:, 2:].prod(1)
-                    mxyxy = xyxyn * torch.tensor([mask_w, mask_h, mask_w, mask_h], device=self.device)
-                    loss[1] += self.single_mask_loss(gt_mask, pred_masks[i][fg_mask[i]], proto[i], mxyxy,
-                                                     marea)  # seg loss
+            loss[1] += mask_loss(masks, batch_idx, fg_mask, target_gt_idx, target_bboxes, pred_masks, proto, imgsz,
+                                 self.overlap)  # seg loss
         # Semantic Segmentation
+        if semasks.ndim == 3:  # class-id maps, nearest resampled to the prediction size
+            semasks = semantic_onehot(proto_masks(semasks, psemasks.shape[2:]), psemasks.shape[1])
+
         # focal loss
         pt = torch.flatten(psemasks, start_dim = 2).permute(0, 2, 1)
         gt = torch.flatten(semasks, start_dim = 2).permute(0, 2, 1)
@@ -277,9 +202,3 @@ class ComputeLoss:
         loss[5] *= 2.5 #/ batch_size
 
         return loss.sum() * batch_size, loss.detach()  # loss(box, cls, dfl)
-
-    def single_mask_loss(self, gt_mask, pred, proto, xyxy, area):
-        # Mask loss for one image
-        pred_mask = (pred @ proto.view(self.nm, -1)).view(-1, *proto.shape[1:])  # (n, 32) @ (32,80,80) -> (n,80,80)
-        loss = F.binary_cross_entropy_with_logits(pred_mask, gt_mask, reduction='none')
-        return (crop_mask(loss, xyxy).mean(dim=(1, 2)) / area).mean()
@@ -177,43 +177,37 @@ class Semantic_Metrics:
     def __init__(self, nc, device):
         self.nc = nc  # number of classes
         self.device = device
-        self.iou = []
-        self.c_bit_counts = torch.zeros(nc, dtype = torch.long).to(device)
-        self.c_intersection_counts = torch.zeros(nc, dtype = torch.long).to(device)
-        self.c_union_counts = torch.zeros(nc, dtype = torch.long).to(device)
+        self.reset()
 
     def update(self, pred_masks, target_masks):
+        # pred_masks (b, nc, h, w) scores, target_masks (b, nc, h, w) one-hot or (b, h, w) class ids, -1 where unlabelled
         nb, nc, h, w = pred_masks.shape
-        device = pred_masks.device
-
-        for b in range(nb):
-            onehot_mask = pred_masks[b].to(device)
-            # convert predict mask to one hot
-            semantic_mask = torch.flatten(onehot_mask, start_dim = 1).permute(1, 0) # class x h x w -> (h x w) x class
-            max_idx = semantic_mask.argmax(1)
-            output_masks = (torch.zeros(semantic_mask.shape).to(self.device)).scatter(1, max_idx.unsqueeze(1), 1.0) # one hot: (h x w) x class
-            output_masks = torch.reshape(output_masks.permute(1, 0), (nc, h, w)) # (h x w) x class -> class x h x w
-            onehot_mask = output_masks.int()
-
-            for c in range(self.nc):
-                pred_mask = onehot_mask[c].to(device)
-                target_mask = target_masks[b, c].to(device)
-
-                # calculate IoU
-                intersection = (torch.logical_and(pred_mask, target_mask).sum()).item()
-                union = (torch.logical_or(pred_mask, target_mask).sum()).item()
-                iou = 0. if (0 == union) else (intersection / union)
-
-                # record class pixel counts, intersection counts, union counts
-                self.c_bit_counts[c] += target_mask.int().sum()
-                self.c_intersection_counts[c] += intersection
-                self.c_union_counts[c] += union
-
-                self.iou.append(iou)
+        pred = pred_masks.argmax(1)  # (b, h, w)
+        i = pred + (torch.arange(nb, device=pred.device) * nc).view(-1, 1, 1)  # (image, class) index of each pixel
+        if target_masks.ndim == 3:  # class ids
+            t = target_masks.long()
+            hit = pred == t
+            labelled = (t >= 0) & (t < nc)
+            gt = torch.bincount((i - pred + t)[labelled], minlength=nb * nc)
+        else:
+            hit = target_masks.gather(1, pred[:, None])[:, 0] > 0
+            gt = (target_masks > 0).sum((2, 3)).view(-1)
+
+        # (image, class) intersection and union pixel counts
+        intersection = torch.bincount(i[hit], minlength=nb * nc)
+        union = torch.bincount(i.view(-1), minlength=nb * nc) + gt - intersection
+        iou = torch.where(union > 0, intersection.double() / union.clamp(min=1), 0.)
+
+        # record class pixel counts, intersection counts, union counts
+        self.c_bit_counts += gt.view(nb, nc).sum(0).to(self.device)
+        self.c_intersection_counts += intersection.view(nb, nc).sum(0).to(self.device)
+        self.c_union_counts += union.view(nb, nc).sum(0).to(self.device)
+        self.iou_sum += iou.sum().to(self.device)
+        self.n += nb * nc  # number of (image, class) IoUs
 
     def results(self):
-        # Mean IoU
-        miou = 0. if (0 == len(self.iou)) else np.sum(self.iou) / (len(self.iou) * self.nc)
+        # Mean IoU, the (image, class) IoU sum over n * nc as reported so far
+        miou = 0. if (0 == self.n) else self.iou_sum.item() / (self.n * self.nc)
 
         # Frequency Weighted IoU
         c_iou = self.c_intersection_counts / (self.c_union_counts + 1)  # add smooth
@@ -225,7 +219,8 @@ class Semantic_Metrics:
         return (miou, fwiou)
 
     def reset(self):
-        self.iou = []
+        self.n = 0
+        self.iou_sum = torch.zeros((), dtype = torch.float64).to(self.device)
         self.c_bit_counts = torch.zeros(self.nc, dtype = torch.long).to(self.device)
         self.c_intersection_counts = torch.zeros(self.nc, dtype = torch.long).to(self.device)
         self.c_union_counts = torch.zeros(self.nc, dtype = torch.long).to(self.device)
@@ -11,12 +11,16 @@ from torchvision.utils import draw_segmentation_masks, save_image
 
 from .. import threaded
 from ..general import xywh2xyxy
+from .general import semantic_onehot
 from ..plots import Annotator, colors
 
 
 @threaded
 def plot_images_and_masks(images, targets, masks, semasks, paths=None, fname='images.jpg', names=None):
 
+    if semasks.ndim == 3:  # class-id maps
+        semasks = semantic_onehot(semasks, max(int(semasks.max()) + 1, 1))
+
     try:
         if images.shape[-2:] != semasks.shape[-2:]:
             m = torch.nn.Upsample(scale_factor=4, mode='nearest')
@@ -16,7 +16,7 @@ def select_candidates_in_gts(xy_centers, gt_bboxes, eps=1e-9):
     """
     n_anchors = xy_centers.shape[0]
     bs, n_boxes, _ = gt_bboxes.shape
-    lt, rb = gt_bboxes.view(-1, 1, 4).chunk(2, 2)  # left-top, right-bottom
+    lt, rb = gt_bboxes.reshape(-1, 1, 4).chunk(2, 2)  # left-top, right-bottom
     bbox_deltas = torch.cat((xy_centers[None] - lt, rb - xy_centers[None]), dim=2).view(bs, n_boxes, n_anchors, -1)
     # return (bbox_deltas.min(3)[0] > eps).to(gt_bboxes.dtype)
     return bbox_deltas.amin(3).gt_(eps)
@@ -49,7 +49,7 @@ def select_highest_overlaps(mask_pos, overlaps, n_max_boxes):
 
 
 class TaskAlignedAssigner(nn.Module):
-    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9):
+    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9, max_mb=0):
         super().__init__()
         self.topk = topk
         self.num_classes = num_classes
@@ -57,6 +57,7 @@ class TaskAlignedAssigner(nn.Module):
         self.alpha = alpha
         self.beta = beta
         self.eps = eps
+        self.max_mb = max_mb  # memory budget of the (b, max_num_obj, h*w) tensors, 0 for unbounded
 
     @torch.no_grad()
     def forward(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt):
@@ -87,6 +88,10 @@ class TaskAlignedAssigner(nn.Module):
                     torch.zeros_like(pd_scores[..., 0]).to(device),
                     torch.zeros_like(pd_scores[..., 0]).to(device))
 
+        chunk = self.chunk_size(pd_scores.size(1))
+        if chunk < self.n_max_boxes:
+            return self.forward_chunked(pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, chunk)
+
         mask_pos, align_metric, overlaps = self.get_pos_mask(pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points,
                                                              mask_gt)
 
@@ -104,6 +109,65 @@ class TaskAlignedAssigner(nn.Module):
 
         return target_labels, target_bboxes, target_scores, fg_mask.bool(), target_gt_idx
 
+    def chunk_size(self, n_anchors):
+        # gt boxes per assignment pass within max_mb, ~(8 * topk + 96) bytes per (image, gt, anchor) at peak
+        if not self.max_mb:
+            return self.n_max_boxes
+        return max(int(self.max_mb * 2 ** 20 / (self.bs * n_anchors * (8 * self.topk + 96))), 1)
+
+    def forward_chunked(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, chunk):
+        """forward() over gt boxes in chunks of `chunk`, giving the same assignment with (b, chunk, h*w) peak tensors.
+        Across chunks only per-anchor state is kept: the positive count, the metrics of a single positive and the
+        highest overlap, which is what select_highest_overlaps() resolves anchors with several positives to.
+        """
+        bs, na, n = self.bs, pd_scores.size(1), self.n_max_boxes
+        device, dtype = gt_bboxes.device, gt_bboxes.dtype
+        fg_count = torch.zeros(bs, na, device=device)
+        pos_gt_idx = torch.zeros(bs, na, dtype=torch.long, device=device)  # gt of single positives
+        pos_align = torch.zeros(bs, na, device=device)
+        pos_overlap = torch.zeros(bs, na, dtype=dtype, device=device)
+        max_overlap = torch.full((bs, na), -1.0, dtype=dtype, device=device)
+        max_gt_idx = torch.zeros(bs, na, dtype=torch.long, device=device)
+        for i in range(0, n, chunk):
+            j = slice(i, i + chunk)
+            mask_pos, align_metric, overlaps = self.get_pos_mask(pd_scores, pd_bboxes, gt_labels[:, j], gt_bboxes[:, j],
+                                                                 anc_points, mask_gt[:, j])
+            fg = mask_pos.sum(-2)
+            fg_count += fg
+            pos_gt_idx = torch.where(fg > 0, mask_pos.argmax(-2) + i, pos_gt_idx)
+            pos_align = pos_align + (align_metric * mask_pos).sum(-2)  # exact for anchors with a single positive
+            pos_overlap += (overlaps * mask_pos).sum(-2)
+            overlap, gt_idx = overlaps.max(-2)
+            higher = overlap > max_overlap  # strict, first maximum wins as with argmax
+            max_overlap = torch.where(higher, overlap, max_overlap)
+            max_gt_idx = torch.where(higher, gt_idx + i, max_gt_idx)
+
+        # anchors assigned to multiple gt_bboxes take the gt of highest overlap
+        multi = fg_count > 1
+        fg_mask = fg_count > 0
+        target_gt_idx = torch.where(multi, max_gt_idx, pos_gt_idx)  # (b, h*w)
+        labels = gt_labels.long().squeeze(-1).gather(1, max_gt_idx)
+        max_align = pd_scores.gather(2, labels.unsqueeze(-1)).squeeze(-1).pow(self.alpha) * max_overlap.pow(self.beta)
+        pos_align = torch.where(multi, max_align, pos_align)
+        pos_overlap = torch.where(multi, max_overlap, pos_overlap)
+
+        # assigned target
+        target_labels, target_bboxes, target_scores = self.get_targets(gt_labels, gt_bboxes, target_gt_idx, fg_mask)
+
+        # normalize, per gt maxima over its positive anchors
+        pos_align_metrics = torch.zeros(bs, n, dtype=pos_align.dtype, device=device)
+        pos_overlaps = torch.zeros(bs, n, dtype=dtype, device=device)
+        for i in range(0, n, chunk):
+            gt_idx = torch.arange(i, min(i + chunk, n), device=device).view(1, -1, 1)
+            mask_pos = (target_gt_idx.unsqueeze(1) == gt_idx) & fg_mask.unsqueeze(1)  # (b, chunk, h*w)
+            pos_align_metrics[:, i:i + chunk] = (pos_align.unsqueeze(1) * mask_pos).amax(-1)
+            pos_overlaps[:, i:i + chunk] = (pos_overlap.unsqueeze(1) * mask_pos).amax(-1)
+        norm_align_metric = pos_align * pos_overlaps.gather(1, target_gt_idx) / (
+            pos_align_metrics.gather(1, target_gt_idx) + self.eps) * fg_mask
+        target_scores = target_scores * norm_align_metric.unsqueeze(-1)
+
+        return target_labels, target_bboxes, target_scores, fg_mask, target_gt_idx
+
     def get_pos_mask(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt):
 
         # get anchor_align metric, (b, max_num_obj, h*w)
@@ -121,8 +185,9 @@ class TaskAlignedAssigner(nn.Module):
     def get_box_metrics(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes):
 
         gt_labels = gt_labels.to(torch.long)  # b, max_num_obj, 1
-        ind = torch.zeros([2, self.bs, self.n_max_boxes], dtype=torch.long)  # 2, b, max_num_obj
-        ind[0] = torch.arange(end=self.bs).view(-1, 1).repeat(1, self.n_max_boxes)  # b, max_num_obj
+        n_boxes = gt_labels.size(1)  # max_num_obj, or a chunk of it
+        ind = torch.zeros([2, self.bs, n_boxes], dtype=torch.long)  # 2, b, max_num_obj
+        ind[0] = torch.arange(end=self.bs).view(-1, 1).repeat(1, n_boxes)  # b, max_num_obj
         ind[1] = gt_labels.squeeze(-1)  # b, max_num_obj
         # get the scores of each grid for each gt cls
         bbox_scores = pd_scores[ind[0], :, ind[1]]  # b, max_num_obj, h*w
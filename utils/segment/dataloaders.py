@@ -6,8 +6,8 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader, distributed
 
-from ..augmentations import augment_hsv, copy_paste, letterbox
-from ..dataloaders import InfiniteDataLoader, LoadImagesAndLabels, seed_worker
+from ..augmentations import augment_batch, augment_hsv, copy_paste, flip_batch, letterbox
+from ..dataloaders import InfiniteDataLoader, LoadImagesAndLabels, seed_worker, unpack_mask
 from ..general import LOGGER, xyn2xy, xywhn2xyxy, xyxy2xywhn
 from ..torch_utils import torch_distributed_zero_first
 from .augmentations import mixup, random_perspective
@@ -33,7 +33,9 @@ def create_dataloader(path,
                       prefix='',
                       shuffle=False,
                       mask_downsample_ratio=1,
-                      overlap_mask=False):
+                      overlap_mask=False,
+                      batch_augment=False,
+                      cache_masks=False):
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -52,7 +54,9 @@ def create_dataloader(path,
             image_weights=image_weights,
             prefix=prefix,
             downsample_ratio=mask_downsample_ratio,
-            overlap=overlap_mask)
+            overlap=overlap_mask,
+            cache_masks=cache_masks)
+    dataset.batch_augment = batch_augment and augment  # HSV and flips left to the training loop, see augment_batch()
 
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
@@ -94,11 +98,15 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
         prefix="",
         downsample_ratio=1,
         overlap=False,
+        cache_masks=False,
     ):
         super().__init__(path, img_size, batch_size, augment, hyp, rect, image_weights, cache_images, single_cls,
                          stride, pad, min_items, prefix)
         self.downsample_ratio = downsample_ratio
         self.overlap = overlap
+        self.mask_cache = None  # run-length encoded masks, only without augmentation
+        if cache_masks and not augment:
+            self.mask_cache = self.cache_masks([self.segments], prefix)
 
     def __getitem__(self, index):
         index = self.indices[index]  # linear, shuffled, or image_weights
@@ -152,18 +160,11 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
         nl = len(labels)  # number of labels
         if nl:
             labels[:, 1:5] = xyxy2xywhn(labels[:, 1:5], w=img.shape[1], h=img.shape[0], clip=True, eps=1e-3)
-            if self.overlap:
-                masks, sorted_idx = polygons2masks_overlap(img.shape[:2],
-                                                           segments,
-                                                           downsample_ratio=self.downsample_ratio)
-                masks = masks[None]  # (640, 640) -> (1, 640, 640)
-                labels = labels[sorted_idx]
-            else:
-                masks = polygons2masks(img.shape[:2], segments, color=1, downsample_ratio=self.downsample_ratio)
-
-        masks = (torch.from_numpy(masks) if len(masks) else torch.zeros(1 if self.overlap else nl, img.shape[0] //
-                                                                        self.downsample_ratio, img.shape[1] //
-                                                                        self.downsample_ratio))
+        if self.mask_cache is not None:  # rasterized once
+            masks, order = (unpack_mask(self.mask_cache, index * 2 + j) for j in range(2))
+            masks, labels = torch.from_numpy(masks), labels[order]
+        else:
+            masks, labels = self.polygon_masks(img.shape[:2], labels, segments)
         # TODO: albumentations support
         if self.augment:
             # Albumentations
@@ -172,6 +173,7 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
             img, labels = self.albumentations(img, labels)
             nl = len(labels)  # update after albumentations
 
+        if self.augment and not self.batch_augment:
             # HSV color-space
             augment_hsv(img, hgain=hyp["hsv_h"], sgain=hyp["hsv_s"], vgain=hyp["hsv_v"])
 
@@ -201,6 +203,36 @@ class LoadImagesAndLabelsAndMasks(LoadImagesAndLabels):  # for training/testing
 
         return (torch.from_numpy(img), labels_out, self.im_files[index], shapes, masks)
 
+    def augment_batch(self, im, targets, masks):
+        # HSV and flip augmentation of a collated uint8 batch in place, flipping masks to match
+        ud, lr = augment_batch(im, targets, self.hyp)
+        i = slice(None) if self.overlap else targets[:, 0].long()  # mask image index, one mask per image if overlap
+        flip_batch(masks, ud[i], lr[i])
+
+    def polygon_masks(self, shape, labels, segments):
+        # Rasterize segments into masks at downsample_ratio for an image of shape(h,w), labels are reordered if overlap
+        masks, nl = [], len(labels)
+        if nl:
+            if self.overlap:
+                masks, sorted_idx = polygons2masks_overlap(shape, segments, downsample_ratio=self.downsample_ratio)
+                masks = masks[None]  # (640, 640) -> (1, 640, 640)
+                labels = labels[sorted_idx]
+            else:
+                masks = polygons2masks(shape, segments, color=1, downsample_ratio=self.downsample_ratio)
+
+        masks = (torch.from_numpy(masks) if len(masks) else torch.zeros(1 if self.overlap else nl, shape[0] //
+                                                                        self.downsample_ratio, shape[1] //
+                                                                        self.downsample_ratio, dtype=torch.uint8))
+        return masks, labels
+
+    def rasterize(self, i):
+        # Returns the (masks, label order) of image i as __getitem__() rasterizes them without augmentation
+        shape, ratio, pad = self.letterbox_shape(i)
+        h, w = self.im_hw[i]
+        segments = [xyn2xy(x, ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1]) for x in self.segments[i]]
+        masks, order = self.polygon_masks(shape, np.arange(len(self.labels[i])), segments)
+        return masks.numpy(), order
+
     def load_mosaic(self, index):
         # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
         labels4, segments4 = [], []
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import torch
 
 from utils.general import check_version
@@ -5,7 +7,47 @@ from utils.general import check_version
 TORCH_1_10 = check_version(torch.__version__, '1.10.0')
 
 
+class AnchorCache:
+    """make_anchors() grids keyed by level shapes, strides, offset, dtype and device, least recently used evicted first.
+    Shared by the Detect head variants and the losses, so alternating --rect or stream shapes are built once each."""
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.grids = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, feats, strides, grid_cell_offset=0.5):
+        if torch.jit.is_tracing() or torch.onnx.is_in_onnx_export():  # keep the grid in traced graphs
+            return generate_anchors(feats, strides, grid_cell_offset)
+        x = feats[0]
+        key = (tuple(tuple(f.shape[2:]) for f in feats), tuple(torch.as_tensor(strides).tolist()), grid_cell_offset,
+               x.dtype, x.device, torch.is_inference_mode_enabled())  # inference tensors can not be used in autograd
+        if key in self.grids:
+            self.hits += 1
+            self.grids.move_to_end(key)
+            return self.grids[key]
+        self.misses += 1
+        self.grids[key] = generate_anchors(feats, strides, grid_cell_offset)
+        while len(self.grids) > self.maxsize:
+            self.grids.popitem(last=False)
+            self.evictions += 1
+        return self.grids[key]
+
+    def clear(self):
+        self.grids.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(size={len(self.grids)}/{self.maxsize}, hits={self.hits}, '
+                f'misses={self.misses}, evictions={self.evictions})')
+
+
 def make_anchors(feats, strides, grid_cell_offset=0.5):
+    """Anchors from features, cached in ANCHOR_CACHE. The returned tensors are shared, do not modify them in place."""
+    return ANCHOR_CACHE(feats, strides, grid_cell_offset)
+
+
+def generate_anchors(feats, strides, grid_cell_offset=0.5):
     """Generate anchors from features."""
     anchor_points, stride_tensor = [], []
     assert feats is not None
@@ -20,6 +62,9 @@ def make_anchors(feats, strides, grid_cell_offset=0.5):
     return torch.cat(anchor_points), torch.cat(stride_tensor)
 
 
+ANCHOR_CACHE = AnchorCache()
+
+
 def dist2bbox(distance, anchor_points, xywh=True, dim=-1):
     """Transform distance(ltrb) to box(xywh or xyxy)."""
     lt, rb = torch.split(distance, 2, dim)
@@ -36,3 +81,28 @@ def bbox2dist(anchor_points, bbox, reg_max):
     """Transform bbox(xyxy) to dist(ltrb)."""
     x1y1, x2y2 = torch.split(bbox, 2, -1)
     return torch.cat((anchor_points - x1y1, x2y2 - anchor_points), -1).clamp(0, reg_max - 0.01)  # dist (lt, rb)
+
+
+def anchor_levels(feats, strides):
+    """(first anchor, h, w, stride) of each stride level in the make_anchors() order."""
+    levels, start = [], 0
+    for x, stride in zip(feats, strides):
+        h, w = x.shape[2:]
+        levels.append((start, h, w, float(stride)))
+        start += h * w
+    return levels
+
+
+def topk_anchors(box, cls, anchor_points, stride_tensor, topk, conf=0.0):
+    """Inference anchors of the topk highest class scores per image, and no more than the most anchors above conf in any
+    image (at least one, DFL convs need a non-empty input). box(b, 4*reg_max, a) and cls(b, nc, a) logits, anchor_points
+    (2, a) and stride_tensor(1, a) as in Detect."""
+    score = cls.amax(1)  # (b, a)
+    k = min(topk, score.shape[1])
+    if conf > 0:
+        k = min(k, max(int((score.sigmoid() > conf).sum(1).max()), 1))
+    i = score.topk(k, 1)[1]  # (b, k)
+    return (box.gather(2, i[:, None].expand(-1, box.shape[1], -1)),
+            cls.gather(2, i[:, None].expand(-1, cls.shape[1], -1)),
+            anchor_points[:, i].transpose(0, 1),
+            stride_tensor[:, i].transpose(0, 1))
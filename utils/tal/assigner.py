@@ -16,19 +16,57 @@ def select_candidates_in_gts(xy_centers, gt_bboxes, eps=1e-9):
     """
     n_anchors = xy_centers.shape[0]
     bs, n_boxes, _ = gt_bboxes.shape
-    lt, rb = gt_bboxes.view(-1, 1, 4).chunk(2, 2)  # left-top, right-bottom
+    lt, rb = gt_bboxes.reshape(-1, 1, 4).chunk(2, 2)  # left-top, right-bottom
     bbox_deltas = torch.cat((xy_centers[None] - lt, rb - xy_centers[None]), dim=2).view(bs, n_boxes, n_anchors, -1)
     # return (bbox_deltas.min(3)[0] > eps).to(gt_bboxes.dtype)
     return bbox_deltas.amin(3).gt_(eps)
 
 
-def select_highest_overlaps(mask_pos, overlaps, n_max_boxes):
+def candidates_in_gts(xy_centers, gt_bboxes, mask_gt, levels, eps=1e-9):
+    """select_candidates_in_gts() in packed form, only testing the anchors of each stride level whose grid window
+    covers the gt box
+
+    Args:
+        xy_centers (Tensor): shape(h*w, 2)
+        gt_bboxes (Tensor): shape(b, n_boxes, 4)
+        mask_gt (Tensor): shape(b, n_boxes, 1)
+        levels (List): (first anchor, h, w, stride) per level, see anchor_levels()
+    Return:
+        (Tensor, Tensor, Tensor): image, gt and anchor index of each candidate, shape(n_candidates)
+    """
+    bs, n_boxes, _ = gt_bboxes.shape
+    device = gt_bboxes.device
+    b, g = mask_gt.squeeze(-1).nonzero(as_tuple=True)
+    boxes = gt_bboxes[b, g]
+    bi, gi, ai = [], [], []
+    for start, h, w, stride in levels:
+        # anchor centres are at (i + 0.5) * stride, the window is padded by one cell and refined below
+        lt = (boxes[:, :2] / stride - 0.5).floor().long().clamp_(0)
+        rb = (boxes[:, 2:] / stride - 0.5).ceil().long() + 1
+        rb = torch.minimum(rb, torch.tensor([w, h], device=device))
+        nx, ny = (rb - lt).clamp_(0).unbind(1)
+        n = nx * ny  # window size per gt
+        k = torch.repeat_interleave(n)  # gt of each window cell
+        j = torch.arange(len(k), device=device) - (n.cumsum(0) - n)[k]  # cell index within the window
+        x, y = lt[k, 0] + j % nx[k], lt[k, 1] + j // nx[k]
+        bi.append(b[k])
+        gi.append(g[k])
+        ai.append(start + y * w + x)
+    bi, gi, ai = torch.cat(bi), torch.cat(gi), torch.cat(ai)
+    lt, rb = gt_bboxes[bi, gi].chunk(2, 1)
+    xy = xy_centers[ai]
+    i = torch.cat((xy - lt, rb - xy), 1).amin(1).gt_(eps).bool()
+    return bi[i], gi[i], ai[i]
+
+
+def select_highest_overlaps(mask_pos, overlaps, n_max_boxes, max_overlaps_idx=None):
     """if an anchor box is assigned to multiple gts,
         the one with the highest iou will be selected.
 
     Args:
         mask_pos (Tensor): shape(b, n_max_boxes, h*w)
         overlaps (Tensor): shape(b, n_max_boxes, h*w)
+        max_overlaps_idx (Tensor): overlaps.argmax(1) if already known, shape(b, h*w)
     Return:
         target_gt_idx (Tensor): shape(b, h*w)
         fg_mask (Tensor): shape(b, h*w)
@@ -38,7 +76,8 @@ def select_highest_overlaps(mask_pos, overlaps, n_max_boxes):
     fg_mask = mask_pos.sum(-2)
     if fg_mask.max() > 1:  # one anchor is assigned to multiple gt_bboxes
         mask_multi_gts = (fg_mask.unsqueeze(1) > 1).repeat([1, n_max_boxes, 1])  # (b, n_max_boxes, h*w)
-        max_overlaps_idx = overlaps.argmax(1)  # (b, h*w)
+        if max_overlaps_idx is None:
+            max_overlaps_idx = overlaps.argmax(1)  # (b, h*w)
         is_max_overlaps = F.one_hot(max_overlaps_idx, n_max_boxes)  # (b, h*w, n_max_boxes)
         is_max_overlaps = is_max_overlaps.permute(0, 2, 1).to(overlaps.dtype)  # (b, n_max_boxes, h*w)
         mask_pos = torch.where(mask_multi_gts, is_max_overlaps, mask_pos)  # (b, n_max_boxes, h*w)
@@ -49,7 +88,7 @@ def select_highest_overlaps(mask_pos, overlaps, n_max_boxes):
 
 
 class TaskAlignedAssigner(nn.Module):
-    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9):
+    def __init__(self, topk=13, num_classes=80, alpha=1.0, beta=6.0, eps=1e-9, max_mb=0, sparse=False):
         super().__init__()
         self.topk = topk
         self.num_classes = num_classes
@@ -57,9 +96,11 @@ class TaskAlignedAssigner(nn.Module):
         self.alpha = alpha
         self.beta = beta
         self.eps = eps
+        self.max_mb = max_mb  # memory budget of the (b, max_num_obj, h*w) tensors, 0 for unbounded
+        self.sparse = sparse  # assign over the anchors inside each gt box only, needs levels in forward()
 
     @torch.no_grad()
-    def forward(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt):
+    def forward(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, levels=None):
         """This code referenced to
            https://github.com/Nioolek/PPYOLOE_pytorch/blob/master/ppyoloe/assigner/tal_assigner.py
 
@@ -70,6 +111,7 @@ class TaskAlignedAssigner(nn.Module):
             gt_labels (Tensor): shape(bs, n_max_boxes, 1)
             gt_bboxes (Tensor): shape(bs, n_max_boxes, 4)
             mask_gt (Tensor): shape(bs, n_max_boxes, 1)
+            levels (List): (first anchor, h, w, stride) per level of anc_points, see anchor_levels()
         Returns:
             target_labels (Tensor): shape(bs, num_total_anchors)
             target_bboxes (Tensor): shape(bs, num_total_anchors, 4)
@@ -86,10 +128,44 @@ class TaskAlignedAssigner(nn.Module):
                     torch.zeros_like(pd_scores).to(device),
                     torch.zeros_like(pd_scores[..., 0]).to(device))
 
+        if self.sparse and levels is not None:
+            return self.forward_sparse(pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, levels)
+
+        chunk = self.chunk_size(pd_scores.size(1))
+        if chunk < self.n_max_boxes:
+            return self.forward_chunked(pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, chunk)
+
         mask_pos, align_metric, overlaps = self.get_pos_mask(pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points,
                                                              mask_gt)
+        return self.assign(mask_pos, align_metric, overlaps, gt_labels, gt_bboxes)
 
-        target_gt_idx, fg_mask, mask_pos = select_highest_overlaps(mask_pos, overlaps, self.n_max_boxes)
+    @torch.no_grad()
+    def forward_heads(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, levels=None):
+        """forward() for several heads on the same anchors, pd_scores a list with one tensor per head. The candidate
+        mask and the CIoU of pd_bboxes (the lead head's boxes) with its per-anchor argmax are computed once; the align
+        metric, top-k and normalization stay per head. Returns a list of forward() outputs.
+        """
+        self.bs = pd_bboxes.size(0)
+        self.n_max_boxes = gt_bboxes.size(1)
+        if self.n_max_boxes == 0 or (self.sparse and levels is not None) or \
+                self.chunk_size(pd_bboxes.size(1)) < self.n_max_boxes:
+            return [self(x, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, levels) for x in pd_scores]
+
+        overlaps = bbox_iou(gt_bboxes.unsqueeze(2), pd_bboxes.unsqueeze(1), xywh=False, CIoU=True)
+        overlaps = overlaps.squeeze(3).clamp(0)
+        mask_in_gts = select_candidates_in_gts(anc_points, gt_bboxes)
+        max_overlaps_idx = overlaps.argmax(1)
+        out = []
+        for x in pd_scores:
+            mask_pos, align_metric, _ = self.get_pos_mask(x, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt,
+                                                          overlaps, mask_in_gts)
+            out.append(self.assign(mask_pos, align_metric, overlaps, gt_labels, gt_bboxes, max_overlaps_idx))
+        return out
+
+    def assign(self, mask_pos, align_metric, overlaps, gt_labels, gt_bboxes, max_overlaps_idx=None):
+        # positives to targets, (b, max_num_obj, h*w) inputs
+        target_gt_idx, fg_mask, mask_pos = select_highest_overlaps(mask_pos, overlaps, self.n_max_boxes,
+                                                                   max_overlaps_idx)
 
         # assigned target
         target_labels, target_bboxes, target_scores = self.get_targets(gt_labels, gt_bboxes, target_gt_idx, fg_mask)
@@ -103,12 +179,124 @@ class TaskAlignedAssigner(nn.Module):
 
         return target_labels, target_bboxes, target_scores, fg_mask.bool()
 
-    def get_pos_mask(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt):
+    def chunk_size(self, n_anchors):
+        # gt boxes per assignment pass within max_mb, ~128 bytes per (image, gt, anchor) at peak
+        if not self.max_mb:
+            return self.n_max_boxes
+        return max(int(self.max_mb * 2 ** 20 / (self.bs * n_anchors * 128)), 1)
+
+    def forward_chunked(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, chunk):
+        """forward() over gt boxes in chunks of `chunk`, giving the same assignment with (b, chunk, h*w) peak tensors.
+        Across chunks only per-anchor state is kept: the positive count, the metrics of a single positive and the
+        highest overlap, which is what select_highest_overlaps() resolves anchors with several positives to.
+        """
+        bs, na, n = self.bs, pd_scores.size(1), self.n_max_boxes
+        device, dtype = gt_bboxes.device, gt_bboxes.dtype
+        fg_count = torch.zeros(bs, na, device=device)
+        pos_gt_idx = torch.zeros(bs, na, dtype=torch.long, device=device)  # gt of single positives
+        pos_align = torch.zeros(bs, na, device=device)
+        pos_overlap = torch.zeros(bs, na, dtype=dtype, device=device)
+        max_overlap = torch.full((bs, na), -1.0, dtype=dtype, device=device)
+        max_gt_idx = torch.zeros(bs, na, dtype=torch.long, device=device)
+        for i in range(0, n, chunk):
+            j = slice(i, i + chunk)
+            mask_pos, align_metric, overlaps = self.get_pos_mask(pd_scores, pd_bboxes, gt_labels[:, j], gt_bboxes[:, j],
+                                                                 anc_points, mask_gt[:, j])
+            fg = mask_pos.sum(-2)
+            fg_count += fg
+            pos_gt_idx = torch.where(fg > 0, mask_pos.argmax(-2) + i, pos_gt_idx)
+            pos_align = pos_align + (align_metric * mask_pos).sum(-2)  # exact for anchors with a single positive
+            pos_overlap += (overlaps * mask_pos).sum(-2)
+            overlap, gt_idx = overlaps.max(-2)
+            higher = overlap > max_overlap  # strict, first maximum wins as with argmax
+            max_overlap = torch.where(higher, overlap, max_overlap)
+            max_gt_idx = torch.where(higher, gt_idx + i, max_gt_idx)
+
+        # anchors assigned to multiple gt_bboxes take the gt of highest overlap
+        multi = fg_count > 1
+        fg_mask = fg_count > 0
+        target_gt_idx = torch.where(multi, max_gt_idx, pos_gt_idx)  # (b, h*w)
+        labels = gt_labels.long().squeeze(-1).gather(1, max_gt_idx)
+        max_align = pd_scores.gather(2, labels.unsqueeze(-1)).squeeze(-1).pow(self.alpha) * max_overlap.pow(self.beta)
+        pos_align = torch.where(multi, max_align, pos_align)
+        pos_overlap = torch.where(multi, max_overlap, pos_overlap)
+
+        # assigned target
+        target_labels, target_bboxes, target_scores = self.get_targets(gt_labels, gt_bboxes, target_gt_idx, fg_mask)
+
+        # normalize, per gt maxima over its positive anchors
+        pos_align_metrics = torch.zeros(bs, n, dtype=pos_align.dtype, device=device)
+        pos_overlaps = torch.zeros(bs, n, dtype=dtype, device=device)
+        for i in range(0, n, chunk):
+            gt_idx = torch.arange(i, min(i + chunk, n), device=device).view(1, -1, 1)
+            mask_pos = (target_gt_idx.unsqueeze(1) == gt_idx) & fg_mask.unsqueeze(1)  # (b, chunk, h*w)
+            pos_align_metrics[:, i:i + chunk] = (pos_align.unsqueeze(1) * mask_pos).amax(-1)
+            pos_overlaps[:, i:i + chunk] = (pos_overlap.unsqueeze(1) * mask_pos).amax(-1)
+        norm_align_metric = pos_align * pos_overlaps.gather(1, target_gt_idx) / (
+            pos_align_metrics.gather(1, target_gt_idx) + self.eps) * fg_mask
+        target_scores = target_scores * norm_align_metric.unsqueeze(-1)
+
+        return target_labels, target_bboxes, target_scores, fg_mask
+
+    def forward_sparse(self, pd_scores, pd_bboxes, anc_points, gt_labels, gt_bboxes, mask_gt, levels):
+        """forward() over the (gt, anchor) pairs with the anchor centre inside the gt box, so the cost follows the
+        object area rather than b * max_num_obj * h*w. Zero-metric candidates, which only tie with anchors outside
+        the box in the dense top-k, are not ranked.
+        """
+        bs, na, n = self.bs, pd_scores.size(1), self.n_max_boxes
+        device = gt_bboxes.device
+        b, g, a = candidates_in_gts(anc_points, gt_bboxes, mask_gt, levels)
+
+        # metrics and top-k per gt over its candidates
+        labels = gt_labels.long().squeeze(-1)
+        overlaps = bbox_iou(gt_bboxes[b, g], pd_bboxes[b, a], xywh=False, CIoU=True).squeeze(-1).clamp(0)
+        align_metric = pd_scores[b, a, labels[b, g]].pow(self.alpha) * overlaps.pow(self.beta)
+        i = align_metric.argsort(descending=True)
+        i = i[(b[i] * n + g[i]).sort(stable=True)[1]]  # by gt, then metric descending
+        key = b[i] * n + g[i]
+        _, counts = key.unique_consecutive(return_counts=True)
+        rank = torch.arange(len(i), device=device) - (counts.cumsum(0) - counts).repeat_interleave(counts)
+        i = i[(rank < self.topk) & (align_metric[i] > 0)]
+        b, g, a, align_metric, overlaps = b[i], g[i], a[i], align_metric[i], overlaps[i]
+
+        # anchors assigned to multiple gt_bboxes take the gt of highest overlap, as select_highest_overlaps()
+        anchors, inverse, counts = (b * na + a).unique(return_inverse=True, return_counts=True)
+        single = counts[inverse] == 1
+        multi = anchors[counts > 1]
+        mb, ma = multi // na, multi % na
+        multi_overlaps = bbox_iou(gt_bboxes[mb], pd_bboxes[mb, ma].unsqueeze(1), xywh=False, CIoU=True)
+        multi_overlaps, mg = multi_overlaps.squeeze(-1).clamp(0).max(1)
+        multi_align = pd_scores[mb, ma, labels[mb, mg]].pow(self.alpha) * multi_overlaps.pow(self.beta)
+        b, g, a = torch.cat((b[single], mb)), torch.cat((g[single], mg)), torch.cat((a[single], ma))
+        align_metric = torch.cat((align_metric[single], multi_align))
+        overlaps = torch.cat((overlaps[single], multi_overlaps))
+
+        target_gt_idx = torch.zeros(bs, na, dtype=torch.long, device=device)
+        target_gt_idx[b, a] = g
+        fg_mask = torch.zeros(bs, na, dtype=torch.bool, device=device)
+        fg_mask[b, a] = True
+
+        # assigned target
+        target_labels, target_bboxes, target_scores = self.get_targets(gt_labels, gt_bboxes, target_gt_idx, fg_mask)
+
+        # normalize
+        key = b * n + g
+        pos_align_metrics = align_metric.new_zeros(bs * n).scatter_reduce_(0, key, align_metric, 'amax')
+        pos_overlaps = overlaps.new_zeros(bs * n).scatter_reduce_(0, key, overlaps, 'amax')
+        norm_align_metric = torch.zeros(bs, na, dtype=align_metric.dtype, device=device)
+        norm_align_metric[b, a] = align_metric * pos_overlaps[key] / (pos_align_metrics[key] + self.eps)
+        target_scores = target_scores * norm_align_metric.unsqueeze(-1)
+
+        return target_labels, target_bboxes, target_scores, fg_mask
+
+    def get_pos_mask(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, anc_points, mask_gt, overlaps=None,
+                     mask_in_gts=None):
 
         # get anchor_align metric, (b, max_num_obj, h*w)
-        align_metric, overlaps = self.get_box_metrics(pd_scores, pd_bboxes, gt_labels, gt_bboxes)
+        align_metric, overlaps = self.get_box_metrics(pd_scores, pd_bboxes, gt_labels, gt_bboxes, overlaps)
         # get in_gts mask, (b, max_num_obj, h*w)
-        mask_in_gts = select_candidates_in_gts(anc_points, gt_bboxes)
+        if mask_in_gts is None:
+            mask_in_gts = select_candidates_in_gts(anc_points, gt_bboxes)
         # get topk_metric mask, (b, max_num_obj, h*w)
         mask_topk = self.select_topk_candidates(align_metric * mask_in_gts,
                                                 topk_mask=mask_gt.repeat([1, 1, self.topk]).bool())
@@ -117,16 +305,19 @@ class TaskAlignedAssigner(nn.Module):
 
         return mask_pos, align_metric, overlaps
 
-    def get_box_metrics(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes):
+    def get_box_metrics(self, pd_scores, pd_bboxes, gt_labels, gt_bboxes, overlaps=None):
 
         gt_labels = gt_labels.to(torch.long)  # b, max_num_obj, 1
-        ind = torch.zeros([2, self.bs, self.n_max_boxes], dtype=torch.long)  # 2, b, max_num_obj
-        ind[0] = torch.arange(end=self.bs).view(-1, 1).repeat(1, self.n_max_boxes)  # b, max_num_obj
+        n_boxes = gt_labels.size(1)  # max_num_obj, or a chunk of it
+        ind = torch.zeros([2, self.bs, n_boxes], dtype=torch.long)  # 2, b, max_num_obj
+        ind[0] = torch.arange(end=self.bs).view(-1, 1).repeat(1, n_boxes)  # b, max_num_obj
         ind[1] = gt_labels.squeeze(-1)  # b, max_num_obj
         # get the scores of each grid for each gt cls
         bbox_scores = pd_scores[ind[0], :, ind[1]]  # b, max_num_obj, h*w
 
-        overlaps = bbox_iou(gt_bboxes.unsqueeze(2), pd_bboxes.unsqueeze(1), xywh=False, CIoU=True).squeeze(3).clamp(0)
+        if overlaps is None:
+            overlaps = bbox_iou(gt_bboxes.unsqueeze(2), pd_bboxes.unsqueeze(1), xywh=False, CIoU=True)
+            overlaps = overlaps.squeeze(3).clamp(0)
         align_metric = bbox_scores.pow(self.alpha) * overlaps.pow(self.beta)
         return align_metric, overlaps
 
@@ -137,15 +328,15 @@ class TaskAlignedAssigner(nn.Module):
             topk_mask: (b, max_num_obj, topk) or None
         """
 
-        num_anchors = metrics.shape[-1]  # h*w
         # (b, max_num_obj, topk)
         topk_metrics, topk_idxs = torch.topk(metrics, self.topk, dim=-1, largest=largest)
         if topk_mask is None:
             topk_mask = (topk_metrics.max(-1, keepdim=True) > self.eps).tile([1, 1, self.topk])
         # (b, max_num_obj, topk)
         topk_idxs = torch.where(topk_mask, topk_idxs, 0)
-        # (b, max_num_obj, topk, h*w) -> (b, max_num_obj, h*w)
-        is_in_topk = F.one_hot(topk_idxs, num_anchors).sum(-2)
+        # (b, max_num_obj, topk) -> (b, max_num_obj, h*w), counts without the (b, max_num_obj, topk, h*w) one-hot
+        is_in_topk = torch.zeros(metrics.shape, dtype=torch.int32, device=metrics.device)
+        is_in_topk.scatter_add_(-1, topk_idxs, torch.ones_like(topk_idxs, dtype=torch.int32))
         # filter invalid bboxes
         # assigned topk should be unique, this is for dealing with empty labels
         # since empty labels will generate index `0` through `F.one_hot`